@@ -0,0 +1,414 @@
+import slideseg3
+import numpy as np
+import itertools
+import argparse
+import resource
+import shutil
+import time
+import json
+import cv2
+import os
+import sys
+import multiprocessing
+from openslide import OpenSlide
+
+
+def tissuefield(width, height, seed):
+    """
+    Draws a low resolution tissue field: light glass with random pink and
+    purple blobs, blurred so that regions read from it look like tissue
+    :param width: width of the field
+    :param height: height of the field
+    :param seed: seed of the blobs
+    :return: RGB array of the field (float32)
+    """
+    rng = np.random.default_rng(seed)
+    field = np.full((height, width, 3), 235, dtype=np.uint8)
+    for _ in range(int(rng.integers(8, 16))):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(width // 16, width // 4)), int(rng.integers(height // 16, height // 4)))
+        color = tuple(int(value) for value in rng.integers((150, 60, 120), (230, 160, 210)))
+        cv2.ellipse(field, center, axes, float(rng.uniform(0, 180)), 0, 360, color, -1)
+    return cv2.GaussianBlur(field, (0, 0), max(1.0, width / 200.0)).astype(np.float32)
+
+
+def leveltiles(field, width, height, tile, seed, level):
+    """
+    Generates the tiles of a slide level from the tissue field, with noise
+    so that they compress like scanned tissue
+    :param field: tissue field, from tissuefield
+    :param width: width of the level
+    :param height: height of the level
+    :param tile: tile size
+    :param seed: seed of the noise
+    :param level: slide level
+    :return: generator of RGB tiles in row order
+    """
+    scale_x = field.shape[1] / float(width)
+    scale_y = field.shape[0] / float(height)
+    for y in range(0, height, tile):
+        for x in range(0, width, tile):
+            map_x = np.tile(((x + np.arange(tile) + 0.5) * scale_x - 0.5).astype(np.float32), (tile, 1))
+            map_y = np.tile(((y + np.arange(tile) + 0.5) * scale_y - 0.5).astype(np.float32)[:, None], (1, tile))
+            patch = cv2.remap(field, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            noise = np.random.default_rng([seed, level, y, x]).normal(0, 6, (tile, tile, 1))
+            yield np.clip(patch + noise, 0, 255).astype(np.uint8)
+
+
+def makeslide(path, width, height, seed, tile=256):
+    """
+    Writes a synthetic pyramidal slide that OpenSlide reads as an Aperio svs,
+    at 40x with levels downsampled by 4
+    :param path: path of the slide
+    :param width: width of level 0
+    :param height: height of level 0
+    :param seed: seed of the tissue and noise
+    :param tile: tile size of every level
+    :return:
+    """
+    import tifffile
+
+    field = tissuefield(max(64, width // 32), max(64, height // 32), seed)
+    bigtiff = width * height * 3 > 2 ** 31
+    with tifffile.TiffWriter(path, bigtiff=bigtiff) as slide:
+        level = 0
+        level_width, level_height = width, height
+        while level == 0 or min(level_width, level_height) >= 512:
+            description = ''
+            if level == 0:
+                description = ('Aperio Image Library v11.2.1\n{0}x{1} [0,0 {0}x{1}] ({2}x{2}) JPEG/RGB Q=70'
+                               '|AppMag = 40|MPP = 0.2500'.format(width, height, tile))
+            slide.write(leveltiles(field, level_width, level_height, tile, seed, level),
+                        shape=(level_height, level_width, 3), dtype=np.uint8, tile=(tile, tile),
+                        compression='zlib', photometric='rgb', description=description, metadata=None)
+            level += 1
+            level_width, level_height = width // 4 ** level, height // 4 ** level
+
+
+def makexml(path, width, height, regions, seed, keys=('TUMOR', 'STROMA', 'FAT', 'INFLAMMATION')):
+    """
+    Writes an Aperio xml file of random star shaped polygons
+    :param path: path of the xml file
+    :param width: width of level 0
+    :param height: height of level 0
+    :param regions: number of regions
+    :param seed: seed of the polygons
+    :param keys: annotation keys, given to the regions in turn
+    :return:
+    """
+    rng = np.random.default_rng(seed)
+    lines = ['<?xml version="1.0" encoding="ISO-8859-1"?>', '<Annotations MicronsPerPixel="0.25">',
+             '<Annotation Id="1"><Regions>']
+    for region in range(regions):
+        radius = rng.uniform(0.005, 0.08) * min(width, height)
+        x = rng.uniform(radius, width - radius)
+        y = rng.uniform(radius, height - radius)
+        vertices = int(rng.integers(8, 400))
+        angles = np.sort(rng.uniform(0, 2 * np.pi, vertices))
+        radii = radius * rng.uniform(0.6, 1.0, vertices)
+        lines.append('<Region Id="{0}" Text="{1}"><Vertices>'.format(region, keys[region % len(keys)]))
+        lines += ['<Vertex X="{0:.3f}" Y="{1:.3f}" Z="0"/>'.format(x + r * np.cos(a), y + r * np.sin(a))
+                  for a, r in zip(angles, radii)]
+        lines.append('</Vertices></Region>')
+    lines.append('</Regions></Annotation></Annotations>')
+    with open(path, 'w') as file:
+        file.write('\n'.join(lines))
+
+
+def slideinputs(directory, size, regions, seed):
+    """
+    Creates the synthetic slide and xml file of a slide size once
+    :param directory: benchmark directory
+    :param size: (width, height) of level 0
+    :param regions: number of annotation regions
+    :param seed: seed of the slide and annotations
+    :return: slide filename
+    """
+    filename = 'synthetic_{0}x{1}_{2}_{3}.svs'.format(size[0], size[1], regions, seed)
+    slide = os.path.join(directory, 'images', filename)
+    xml = os.path.join(directory, 'xml', filename[:-len('.svs')] + '.xml')
+    if not os.path.isfile(slide):
+        print('generating {0}'.format(filename))
+        slideseg3.ensuredirectory(os.path.dirname(slide))
+        makeslide(slide + '.tmp', size[0], size[1], seed)
+        os.replace(slide + '.tmp', slide)
+    if not os.path.isfile(xml):
+        slideseg3.ensuredirectory(os.path.dirname(xml))
+        makexml(xml, size[0], size[1], regions, seed)
+    return filename
+
+
+def caseparameters(directory, filename, case):
+    """
+    Parameters of a benchmark case, from Parameters.txt with the inputs and
+    output of the benchmark directory
+    :param directory: benchmark directory
+    :param filename: slide filename
+    :param case: dictionary of size, overlap, level, cpus and format
+    :return: parameters
+    """
+    params = slideseg3.load_parameters('Parameters.txt')
+    params.update({"slide_path": os.path.join(directory, 'images', ''),
+                   "xml_path": os.path.join(directory, 'xml', ''),
+                   "output_dir": os.path.join(directory, 'output', ''),
+                   "key": os.path.join(directory, 'Annotation_Key.txt'),
+                   "resume": False,
+                   "profile": 'none'})
+    params.update((name, str(value)) for name, value in case.items())
+    return params
+
+
+def slidemask(params, filename):
+    """
+    Opens a slide and makes its annotation mask
+    :return: slide levels, level dimensions, available magnifications, mask and annotations
+    """
+    _, levels, dims, available = slideseg3.openwholeslide(params["slide_path"] + filename)
+    mask, annotations = slideseg3.makemask(params["key"], dims[0], params["xml_path"] + filename[:-len('.svs')] + '.xml',
+                                           dims)
+    return levels, dims, available, mask, annotations
+
+
+def benchmakemask(params, filename):
+    """
+    Benchmarks makemask: parsing the xml file and building the mask pyramid
+    :return: chips (0), level 0 pixels and seconds
+    """
+    dims = OpenSlide(params["slide_path"] + filename).level_dimensions
+    xml = params["xml_path"] + filename[:-len('.svs')] + '.xml'
+    # parse the xml file, not its cached regions
+    shutil.rmtree(os.path.join(params["xml_path"], '.cache'), ignore_errors=True)
+    start = time.perf_counter()
+    slideseg3.makemask(params["key"], dims[0], xml, dims)
+    return 0, dims[0][0] * dims[0][1], time.perf_counter() - start
+
+
+def benchgetchips(params, filename):
+    """
+    Benchmarks getchips: finding the chips of the selected levels and their keys
+    :return: chips, pixels of the chips and seconds
+    """
+    levels, dims, available, mask, annotations = slidemask(params, filename)
+    level = slideseg3.getDesireLevel(params["level"], levels, available)
+    size = int(params["size"])
+    start = time.perf_counter()
+    chips = slideseg3.getchips(levels, dims, size, int(params["overlap"]), mask, annotations, filename,
+                               params["format"], True, float('inf'), int(params["cpus"]), level=level)
+    return len(chips['table']), len(chips['table']) * size * size, time.perf_counter() - start
+
+
+def benchchipmask(params, filename):
+    """
+    Benchmarks the chip masks: levelmask and curatemask of every chip of level 0
+    :return: chips, pixels of the chips and seconds
+    """
+    levels, dims, available, mask, annotations = slidemask(params, filename)
+    size = int(params["size"])
+    chips = 0
+    start = time.perf_counter()
+    for col in range(0, dims[0][0], size):
+        for row in range(0, dims[0][1], size):
+            slideseg3.curatemask(slideseg3.levelmask(mask, 0, col, row, size, size), 1, 1, size)
+            chips += 1
+    return chips, chips * size * size, time.perf_counter() - start
+
+
+def benchrun(params, filename):
+    """
+    Benchmarks run: saving every chip and mask of the slide
+    :return: chips, pixels of the chips and seconds
+    """
+    shutil.rmtree(params["output_dir"], ignore_errors=True)
+    start = time.perf_counter()
+    slideseg3.run(params, filename)
+    seconds = time.perf_counter() - start
+    chips = len(slideseg3.loadjournal('{0}{1}/journal.txt'.format(params["output_dir"], filename))[0])
+    if params.get("output_type", "files") == 'tar':
+        with open('{0}{1}/shards/{2}_index.txt'.format(params["output_dir"], filename, filename[:-len('.svs')])) as file:
+            chips = sum(1 for _ in file)
+    return chips, chips * int(params["size"]) ** 2, seconds
+
+
+def checkmasks(trials, seed):
+    """
+    Checks that the windows of the annotation mask drawn by _fillregion are
+    pixel for pixel those of cv2.fillPoly on the full slide, for random star
+    shaped regions that often cross the slide edge
+    :param trials: number of regions, each checked in 6 random windows
+    :param seed: seed of the regions and windows
+    :return: number of windows that differ
+    """
+    rng = np.random.default_rng(seed)
+    failed = 0
+    for _ in range(trials):
+        width, height = int(rng.integers(200, 800)), int(rng.integers(200, 800))
+        vertices = 2 * int(rng.integers(5, 12))
+        x, y = rng.integers(-100, width + 100), rng.integers(-100, height + 100)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, vertices))
+        radii = np.where(np.arange(vertices) % 2, rng.uniform(20, 150, vertices), rng.uniform(150, 600, vertices))
+        cnt = np.stack([x + radii * np.cos(angles), y + radii * np.sin(angles)], axis=1)
+        cnt = cnt.round().astype(np.int32).reshape((-1, 1, 2))
+        full = np.zeros((height, width), dtype=np.uint8)
+        cv2.fillPoly(full, [cnt], 200)
+        for _ in range(6):
+            col, row = int(rng.integers(0, width - 1)), int(rng.integers(0, height - 1))
+            size = (int(rng.integers(1, width - col + 1)), int(rng.integers(1, height - row + 1)))
+            window = slideseg3._fillregion(np.zeros((size[1], size[0]), dtype=np.uint8), cnt, 200, col, row,
+                                           (width, height))
+            differ = np.argwhere(window != full[row:row + size[1], col:col + size[0]])
+            if len(differ) > 0:
+                failed += 1
+                print('slide {0}x{1}, window at ({2}, {3}) differs at {4} pixels, first (x, y) = ({5}, {6})'.format(
+                    width, height, col, row, len(differ), col + differ[0][1], row + differ[0][0]))
+    print('{0} of {1} mask windows differ from cv2.fillPoly'.format(failed, trials * 6))
+    return failed
+
+
+benchmarks = {'makemask': benchmakemask, 'getchips': benchgetchips, 'chipmask': benchchipmask, 'run': benchrun}
+
+
+def runcase(results, benchmark, params, filename, log):
+    """
+    Runs a benchmark in a fresh process, so its peak memory is its own
+    :param results: queue for (chips, pixels, seconds, peak bytes)
+    :param benchmark: name of the benchmark
+    :param params: parameters of the case
+    :param filename: slide filename
+    :param log: file the output of the case is written to
+    :return:
+    """
+    output = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.dup2(output, 1)
+    os.dup2(output, 2)
+    chips, pixels, seconds = benchmarks[benchmark](params, filename)
+    # ru_maxrss is in kB, and covers the worker processes of run once joined
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    results.put((chips, pixels, seconds, peak))
+
+
+def measure(benchmark, params, filename, repeat, log):
+    """
+    Runs a benchmark case repeat times
+    :return: dictionary of chips, seconds, chips/s, MPix/s, peak RSS and output bytes of the fastest run
+    """
+    context = multiprocessing.get_context('spawn')
+    best = None
+    for _ in range(repeat):
+        results = context.Queue()
+        process = context.Process(target=runcase, args=(results, benchmark, params, filename, log))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError('{0} failed, see {1}'.format(benchmark, log))
+        chips, pixels, seconds, peak = results.get()
+        if best is None or seconds < best[2]:
+            best = chips, pixels, seconds, peak
+
+    chips, pixels, seconds, peak = best
+    output = 0
+    if benchmark == 'run':
+        output = sum(os.path.getsize(os.path.join(root, name))
+                     for root, _, names in os.walk(params["output_dir"]) for name in names)
+    return {'chips': chips, 'seconds': seconds, 'chips/s': chips / seconds if seconds else 0,
+            'MPix/s': pixels / seconds / 1e6 if seconds else 0, 'peak MB': peak / 2 ** 20,
+            'output MB': output / 2 ** 20}
+
+
+def cases(args):
+    """
+    Benchmark cases of the matrices given on the command line
+    :param args: command line arguments
+    :return: list of (name, benchmark, slide size, case parameters)
+    """
+    found = []
+    for slide in args.slides.split(','):
+        size = tuple(int(value) for value in slide.split('x'))
+        matrix = {'size': args.size.split(','), 'overlap': args.overlap.split(','), 'level': args.level.split(','),
+                  'cpus': args.cpus.split(','), 'format': args.format.split(',')}
+        # the micro benchmarks only depend on part of the matrix
+        used = {'makemask': (), 'getchips': ('size', 'overlap', 'level'), 'chipmask': ('size',),
+                'run': ('size', 'overlap', 'level', 'cpus', 'format')}
+        for benchmark in args.benchmarks.split(','):
+            names = used[benchmark]
+            for values in itertools.product(*[matrix[name] for name in names]):
+                case = dict(zip(names, values))
+                name = ' '.join([benchmark, slide] + ['{0}={1}'.format(key, value) for key, value in case.items()])
+                found.append((name, benchmark, size, case))
+    return found
+
+
+def main(args):
+    """
+    Runs the benchmark cases and compares them with the baseline results
+    :param args: command line arguments
+    :return: number of regressions
+    """
+    directory = os.path.abspath(args.dir)
+    slideseg3.ensuredirectory(directory)
+    baseline_path = os.path.join(directory, 'baseline.json')
+    baseline = {}
+    if os.path.isfile(baseline_path):
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+
+    log = os.path.join(directory, 'benchmark.log')
+    results = {}
+    regressions = 0
+    print('{0:<60}{1:>8}{2:>10}{3:>10}{4:>10}{5:>10}{6:>10}  {7}'.format(
+        'case', 'chips', 'seconds', 'chips/s', 'MPix/s', 'peak MB', 'output MB', 'vs baseline'))
+    for name, benchmark, size, case in cases(args):
+        filename = slideinputs(directory, size, args.regions, args.seed)
+        params = caseparameters(directory, filename, case)
+        result = measure(benchmark, params, filename, args.repeat, log)
+        results[name] = result
+
+        # slower throughput or higher peak memory than the baseline by more than the tolerance
+        change = ''
+        if name in baseline:
+            speed = result['MPix/s'] / baseline[name]['MPix/s'] - 1 if baseline[name]['MPix/s'] else 0
+            memory = result['peak MB'] / baseline[name]['peak MB'] - 1
+            change = '{0:+.0%} MPix/s, {1:+.0%} peak'.format(speed, memory)
+            if speed < -args.tolerance or memory > args.tolerance:
+                change += '  REGRESSION'
+                regressions += 1
+        print('{0:<60}{1:>8}{2:>10.2f}{3:>10.1f}{4:>10.1f}{5:>10.0f}{6:>10.1f}  {7}'.format(
+            name, result['chips'], result['seconds'], result['chips/s'], result['MPix/s'], result['peak MB'],
+            result['output MB'], change))
+        sys.stdout.flush()
+
+    with open(os.path.join(directory, 'results.json'), 'w') as file:
+        json.dump(results, file, indent=1)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(baseline_path, 'w') as file:
+            json.dump(baseline, file, indent=1)
+        print('baseline saved to {0}'.format(baseline_path))
+    if regressions:
+        print('{0} regressions over {1:.0%}'.format(regressions, args.tolerance))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks SlideSeg3 on synthetic slides and annotations. "
+                                                 "Other parameters are read from Parameters.txt")
+    parser.add_argument("--dir", default="benchmark", help="Folder of the synthetic slides, output and results")
+    parser.add_argument("--benchmarks", default="makemask,getchips,chipmask,run",
+                        help="Benchmarks to run, from makemask, getchips, chipmask and run")
+    parser.add_argument("--slides", default="8192x6144", help="Level 0 sizes of the synthetic slides, e.g. 8192x6144,32768x24576")
+    parser.add_argument("--regions", type=int, default=40, help="Annotation regions of each synthetic slide")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic slides and annotations")
+    parser.add_argument("--size", default="256", help="Chip sizes")
+    parser.add_argument("--overlap", default="0", help="Chip overlaps")
+    parser.add_argument("--level", default="all", help="Levels")
+    parser.add_argument("--cpus", default="4", help="Numbers of cpus")
+    parser.add_argument("--format", default="tif", help="Output formats")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of each case, the fastest is kept")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Slowdown or memory growth reported as a regression")
+    parser.add_argument("--save-baseline", action="store_true", help="Saves the results as the baseline of later runs")
+    parser.add_argument("--check-masks", type=int, default=0, metavar="REGIONS",
+                        help="Only checks the mask windows of this many random regions against cv2.fillPoly")
+    args = parser.parse_args()
+    if args.check_masks:
+        sys.exit(1 if checkmasks(args.check_masks, args.seed) else 0)
+    sys.exit(1 if main(args) else 0)
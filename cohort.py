@@ -0,0 +1,336 @@
+import slideseg3
+import numpy as np
+import sqlite3
+import shutil
+import socket
+import json
+import time
+import os
+import traceback
+from multiprocessing import Process
+from openslide import OpenSlide
+
+
+def connect(queue_path):
+    """
+    Opens the cohort queue, a SQLite file on a filesystem shared by every worker
+    :param queue_path: path to the queue file
+    :return: connection, transactions are started explicitly
+    """
+    conn = sqlite3.connect(queue_path, timeout=600, isolation_level=None)
+    conn.execute('''CREATE TABLE IF NOT EXISTS slides (
+                        filename TEXT PRIMARY KEY, area INTEGER, state TEXT, owner TEXT, lease REAL,
+                        remaining INTEGER, init TEXT, plan TEXT, attempts INTEGER DEFAULT 0, error TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS units (
+                        id INTEGER PRIMARY KEY, filename TEXT, level INTEGER, area INTEGER, task TEXT,
+                        state TEXT, owner TEXT, lease REAL, attempts INTEGER DEFAULT 0, error TEXT)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS units_state ON units (state, area)')
+    # queues created before slides and region reads could fail
+    for table in ('slides', 'units'):
+        columns = [column[1] for column in conn.execute('PRAGMA table_info({0})'.format(table))]
+        if 'attempts' not in columns:
+            conn.execute('ALTER TABLE {0} ADD COLUMN attempts INTEGER DEFAULT 0'.format(table))
+            conn.execute('ALTER TABLE {0} ADD COLUMN error TEXT'.format(table))
+    return conn
+
+
+def addslides(conn, parameters):
+    """
+    Adds every slide of slide_path to the queue once, with its pixel area at the
+    highest magnification as an estimate of its work
+    :param conn: queue connection
+    :param parameters: specified in Parameters.txt file
+    :return: number of slides in the queue
+    """
+    # slides are opened before taking the write lock, which would hold off
+    # every other job for the whole scan
+    areas = []
+    if conn.execute('SELECT COUNT(*) FROM slides').fetchone()[0] == 0:
+        for filename in os.listdir(parameters["slide_path"]):
+            try:
+                slide = OpenSlide('{0}{1}'.format(parameters["slide_path"], filename))
+            except Exception as error:
+                print('skipping {0}: {1!r}'.format(filename, error))
+                continue
+            width, height = slide.dimensions
+            slide.close()
+            areas.append((filename, width * height))
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # another job may have added the slides since
+        if areas and conn.execute('SELECT COUNT(*) FROM slides').fetchone()[0] == 0:
+            conn.executemany('''INSERT INTO slides (filename, area, state, lease)
+                                VALUES (?, ?, 'pending', 0)''', areas)
+        count = conn.execute('SELECT COUNT(*) FROM slides').fetchone()[0]
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return count
+
+
+def claim(conn, worker, lease, attempts):
+    """
+    Claims the next piece of work. Slides are planned first, largest first, so
+    their region reads reach the queue early; region reads are then claimed
+    largest first. Work whose lease expired is claimed again, until it was
+    claimed attempts times; its slide has then failed
+    :param conn: queue connection
+    :param worker: name of the claiming worker
+    :param lease: seconds a claim is held before others may take it over
+    :param attempts: number of claims of a slide step or region read before its slide fails
+    :return: ('plan', filename), ('finish', filename), ('unit', id, filename, task),
+             ('wait',) if all remaining work is held by others, or None when the cohort is done
+    """
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # work that failed or outlived its lease too often is not claimed again
+        conn.execute('''UPDATE slides SET state = 'failed', owner = NULL
+                        WHERE state IN ('planning', 'finishing') AND lease < ? AND attempts >= ?''',
+                     (now, attempts))
+        conn.execute('''UPDATE units SET state = 'failed', owner = NULL
+                        WHERE state = 'claimed' AND lease < ? AND attempts >= ?''', (now, attempts))
+        conn.execute('''UPDATE slides SET state = 'failed', owner = NULL,
+                            error = (SELECT error FROM units WHERE units.filename = slides.filename
+                                     AND state = 'failed' LIMIT 1)
+                        WHERE state NOT IN ('done', 'failed')
+                        AND filename IN (SELECT filename FROM units WHERE state = 'failed')''')
+
+        slide = conn.execute('''SELECT filename, state FROM slides
+                                WHERE state = 'pending' OR (state IN ('planning', 'finishing') AND lease < ?)
+                                ORDER BY state = 'pending', area DESC LIMIT 1''', (now,)).fetchone()
+        if slide is not None:
+            filename, state = slide
+            state = 'finishing' if state == 'finishing' else 'planning'
+            conn.execute('''UPDATE slides SET state = ?, owner = ?, lease = ?, attempts = attempts + 1
+                            WHERE filename = ?''', (state, worker, now + lease, filename))
+            conn.execute('COMMIT')
+            return ('finish' if state == 'finishing' else 'plan'), filename
+
+        unit = conn.execute('''SELECT id, filename, task FROM units
+                               WHERE (state = 'pending' OR (state = 'claimed' AND lease < ?))
+                               AND filename NOT IN (SELECT filename FROM slides WHERE state = 'failed')
+                               ORDER BY area DESC LIMIT 1''', (now,)).fetchone()
+        if unit is not None:
+            conn.execute('''UPDATE units SET state = 'claimed', owner = ?, lease = ?, attempts = attempts + 1
+                            WHERE id = ?''', (worker, now + lease, unit[0]))
+            conn.execute('COMMIT')
+            return 'unit', unit[0], unit[1], json.loads(unit[2])
+
+        busy = conn.execute("SELECT COUNT(*) FROM slides WHERE state NOT IN ('done', 'failed')").fetchone()[0]
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return ('wait',) if busy else None
+
+
+def planslide(conn, parameters, filename, worker, lease, masks_dir):
+    """
+    Plans a slide and adds its region reads to the queue
+    :param conn: queue connection
+    :param parameters: specified in Parameters.txt file
+    :param filename: filename of whole slide image
+    :param worker: name of the planning worker
+    :param lease: seconds the slide is held for finishing if nothing is left to save
+    :param masks_dir: shared directory of the memory mapped annotation masks and chip plans
+    :return: True if the slide has no region reads left and can be finished
+    """
+    plan = slideseg3.planslide(parameters, filename)
+    if plan is None:
+        conn.execute("UPDATE slides SET state = 'done', remaining = 0 WHERE filename = ? AND owner = ?",
+                     (filename, worker))
+        return False
+
+    # the mask and chip plan are shared with the workers of every node through memory mapped files
+    mask_dir = os.path.join(masks_dir, filename)
+    shutil.rmtree(mask_dir, ignore_errors=True)
+    slideseg3.ensuredirectory(mask_dir)
+    init = [plan['slide_path'], slideseg3.sharemask(plan['mask'], mask_dir), slideseg3.shareplan(plan['chips'], mask_dir),
+            plan['chip_size'], plan['quality'], plan['output_dir'], 'files', parameters.get("write_policy", "none"),
+            int(float(parameters.get("tile_cache", 0)) * 2 ** 20),
+            plan['output_dir'] + 'profile/' if parameters.get("profile", "none") == 'cprofile' else None]
+    slideseg3.keydirectories(plan['output_dir'], [' '.join(keys) for keys in slideseg3.chipkeys(plan['chips'])[0]])
+    np.save(os.path.join(mask_dir, 'digests.npy'), plan['digests'])
+    finish = {name: plan[name] for name in ('filename', 'inputs', 'xml_file', 'journal_path', 'annotations')}
+    finish['chips'] = init[2]
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # the slide may have been claimed again if planning outlived its lease
+        if conn.execute('''UPDATE slides SET state = ?, remaining = ?, init = ?, plan = ?, lease = ?, attempts = 0
+                           WHERE filename = ? AND owner = ? AND state = 'planning' ''',
+                        ('planned' if plan['tasks'] else 'finishing', len(plan['tasks']), json.dumps(init),
+                         json.dumps(finish), time.time() + lease, filename, worker)).rowcount == 0:
+            conn.execute('ROLLBACK')
+            return False
+        for task in plan['tasks']:
+            conn.execute('''INSERT INTO units (filename, level, area, task, state, lease)
+                            VALUES (?, ?, ?, ?, 'pending', 0)''',
+                         (filename, task[0], task[3] * task[4], json.dumps(task[:5] + (task[5].tolist(),))))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+    print('{0}: {1} region reads queued'.format(filename, len(plan['tasks'])))
+    return not plan['tasks']
+
+
+def saveunit(conn, unit_id, filename, task, worker, lease):
+    """
+    Saves the chips of a region read and marks it done
+    :param conn: queue connection
+    :param unit_id: id of the region read
+    :param filename: filename of whole slide image
+    :param task: region read of chip indices, see slideseg3.savereads
+    :param worker: name of the saving worker
+    :param lease: seconds the slide is held for finishing
+    :return: True if this was the last region read of the slide, which this worker then finishes
+    """
+    if slideseg3._worker.get('filename') != filename:
+        init = json.loads(conn.execute('SELECT init FROM slides WHERE filename = ?', (filename,)).fetchone()[0])
+        slideseg3.initworker(*init)
+        slideseg3._worker['filename'] = filename
+
+    slideseg3.savereads(task)
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        last = False
+        # a read claimed again after its lease expired only counts once
+        if conn.execute("UPDATE units SET state = 'done' WHERE id = ? AND state != 'done'",
+                        (unit_id,)).rowcount:
+            conn.execute('UPDATE slides SET remaining = remaining - 1 WHERE filename = ?', (filename,))
+            last = conn.execute('''UPDATE slides SET state = 'finishing', owner = ?, lease = ?, attempts = 0
+                                   WHERE filename = ? AND remaining = 0''',
+                                (worker, time.time() + lease, filename)).rowcount > 0
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return last
+
+
+def finishslide(conn, parameters, filename, worker, masks_dir):
+    """
+    Writes the text output and journal of a slide whose region reads are all done
+    :param conn: queue connection
+    :param parameters: specified in Parameters.txt file
+    :param filename: filename of whole slide image
+    :param worker: name of the finishing worker
+    :param masks_dir: shared directory of the memory mapped annotation masks and chip plans
+    :return:
+    """
+    plan = json.loads(conn.execute('SELECT plan FROM slides WHERE filename = ?', (filename,)).fetchone()[0])
+    plan['chips'] = slideseg3.loadplan(plan['chips'])
+    plan['digests'] = np.load(os.path.join(masks_dir, filename, 'digests.npy'), mmap_mode='r')
+
+    # every planned chip is written now, whether kept from an earlier run or saved by the cohort
+    journal = slideseg3.startjournal(plan['journal_path'], {})
+    try:
+        for start in range(0, len(plan['chips']['table']), 65536):
+            slideseg3.journalchips(journal, plan, slideseg3.chipnames(plan['chips'], slice(start, start + 65536)))
+        slideseg3.finishslide(parameters, plan, journal)
+    finally:
+        journal.close()
+    shutil.rmtree(os.path.join(masks_dir, filename), ignore_errors=True)
+
+    conn.execute("UPDATE slides SET state = 'done' WHERE filename = ? AND owner = ?", (filename, worker))
+    print('{0} finished'.format(filename))
+
+
+def release(conn, job, worker, error):
+    """
+    Records the error of a slide step or region read that raised, and ends its
+    claim so it is claimed again at once, or fails if it was claimed too often
+    :param conn: queue connection
+    :param job: claimed work, see claim
+    :param worker: name of the worker that claimed it
+    :param error: formatted exception
+    :return:
+    """
+    if conn.in_transaction:
+        conn.execute('ROLLBACK')
+    if job[0] == 'unit':
+        conn.execute('UPDATE units SET lease = 0, error = ? WHERE id = ? AND owner = ?', (error, job[1], worker))
+    else:
+        conn.execute('UPDATE slides SET lease = 0, error = ? WHERE filename = ? AND owner = ?',
+                     (error, job[1], worker))
+
+
+def work(parameters, queue_path):
+    """
+    Claims and runs work from the cohort queue until every slide is done
+    :param parameters: specified in Parameters.txt file
+    :param queue_path: path to the queue file
+    :return:
+    """
+    lease = float(parameters.get("queue_lease", 1800))
+    attempts = int(parameters.get("queue_attempts", 3))
+    worker = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    masks_dir = queue_path + '.masks'
+    conn = connect(queue_path)
+
+    while True:
+        job = claim(conn, worker, lease, attempts)
+        if job is None:
+            break
+        # a slide that raises only fails itself, the worker goes on with other work
+        try:
+            if job[0] == 'wait':
+                time.sleep(10)
+            elif job[0] == 'plan':
+                if planslide(conn, parameters, job[1], worker, lease, masks_dir):
+                    job = ('finish', job[1])
+                    finishslide(conn, parameters, job[1], worker, masks_dir)
+            elif job[0] == 'finish':
+                finishslide(conn, parameters, job[1], worker, masks_dir)
+            elif saveunit(conn, job[1], job[2], job[3], worker, lease):
+                job = ('finish', job[2])
+                finishslide(conn, parameters, job[1], worker, masks_dir)
+        except Exception:
+            error = traceback.format_exc()
+            print('{0} failed on {1}:\n{2}'.format(worker, job[2] if job[0] == 'unit' else job[1], error))
+            release(conn, job, worker, error)
+    conn.close()
+
+    # steps of every slide this worker had a part in, to be combined with
+    # the reports of the other workers
+    if parameters.get("profile", "none") in ('report', 'cprofile'):
+        slideseg3.writetimings(os.path.join(queue_path + '.profile', worker), slideseg3.timings())
+
+
+def main(parameters, queue_path):
+    """
+    Runs cpus workers on the cohort queue. Any number of these, on any number of
+    nodes (e.g. SLURM array tasks), can share one queue file
+    :param parameters: specified in Parameters.txt file
+    :param queue_path: path to the queue file
+    :return: number of slides that failed
+    """
+    if parameters.get("output_type", "files") != 'files':
+        print('The cohort queue only supports output_type: files')
+        return
+
+    conn = connect(queue_path)
+    print('{0} slides in {1}'.format(addslides(conn, parameters), queue_path))
+    conn.close()
+    # every job of the cohort adds the keys it finds before its workers start,
+    # the xml files are read once and cached for the others
+    print('{0} annotation keys in {1}'.format(slideseg3.preparekeys(parameters), parameters["xml_path"]))
+
+    workers = [Process(target=work, args=(parameters, queue_path)) for _ in range(int(parameters["cpus"]))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    conn = connect(queue_path)
+    failed = conn.execute("SELECT filename, error FROM slides WHERE state = 'failed'").fetchall()
+    conn.close()
+    for filename, error in failed:
+        print('{0} failed:\n{1}'.format(filename, error))
+    return len(failed)
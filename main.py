@@ -1,20 +1,131 @@
 import slideseg3
+import cohort
 import os
 import sys
 import argparse
-from multiprocessing import Pool, Process
 import timeit
+import time
+from multiprocessing import Process
+from multiprocessing.connection import wait
 
-def Run(params, filename, convert):
+
+def memorybudget(params):
+    """
+    Memory available to the slides run at the same time
+    :param params: parameters from Parameters.txt
+    :return: budget in bytes, from the memory parameter (GB), the memory of
+             the SLURM job, or the physical memory of the node
+    """
+    if float(params.get("memory", 0)) > 0:
+        return float(params["memory"]) * 2 ** 30
+    if 'SLURM_MEM_PER_NODE' in os.environ:
+        return float(os.environ['SLURM_MEM_PER_NODE']) * 2 ** 20
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def runslide(params, filename, convert, cpus):
+    """
+    Runs one slide with its share of the cpus
+    :param params: parameters from Parameters.txt
+    :param filename: filename of the whole slide image
+    :param convert: only converts the annotation mask to tiff if true
+    :param cpus: number of worker processes of the slide
+    :return:
+    """
+    params = dict(params, cpus=cpus)
     slideseg3.run(params, filename, convert)
 
-def main(convert):
+
+def schedule(params, filenames, convert):
+    """
+    Runs slides at the same time while their estimated peak memory fits the
+    memory budget. Slides are admitted largest first, each with a share of the
+    free cpus, and slides that do not fit wait until running slides finish
+    :param params: parameters from Parameters.txt
+    :param filenames: filenames of the whole slide images
+    :param convert: only converts the annotation masks to tiff if true
+    :return:
+    """
+    cpus = int(params["cpus"])
+    budget = memorybudget(params)
+
+    # a file that can not be opened as a slide only fails itself
+    estimates = {}
+    for filename in filenames:
+        try:
+            estimates[filename] = slideseg3.estimatememory(params, filename, convert)
+        except Exception as error:
+            print('skipping {0}: {1!r}'.format(filename, error))
+    pending = sorted(estimates, key=lambda filename: sum(estimates[filename]), reverse=True)
+    print('memory budget {0:.1f} GB for {1} slides'.format(budget / 2 ** 30, len(pending)))
+
+    running = {}
+    while pending or running:
+        free_cpus = cpus - sum(used for used, _ in running.values())
+        free_memory = budget - sum(memory for _, memory in running.values())
+
+        admitted = None
+        for filename in pending:
+            base, worker = estimates[filename]
+            # share the free cpus between the slides waiting for them
+            share = min(free_cpus, -(-cpus // min(cpus, len(pending))))
+            if worker:
+                fit = min(share, int((free_memory - base) // worker))
+            else:
+                fit = share if base <= free_memory else 0
+            if fit >= 1 or (not running and free_cpus > 0):
+                # a slide larger than the budget runs alone, with one worker
+                admitted = filename, max(fit, 1)
+                break
+
+        if admitted is None:
+            wait([process.sentinel for process in running])
+            for process in [process for process in running if not process.is_alive()]:
+                process.join()
+                del running[process]
+            continue
+
+        filename, used = admitted
+        pending.remove(filename)
+        base, worker = estimates[filename]
+        print('starting {0} with {1} cpus, estimated {2:.1f} GB'.format(
+            filename, used, (base + used * worker) / 2 ** 30))
+        process = Process(target=runslide, args=(params, filename, convert, used))
+        process.start()
+        running[process] = (used, base + used * worker)
+
+
+def writeprofile(params, filenames, since):
+    """
+    Combines the reports of instrumented steps of the slides of a run into
+    output_dir/profile.json and profile.csv
+    :param params: parameters from Parameters.txt
+    :param filenames: filenames of the whole slide images
+    :param since: start time of the run, reports of slides skipped by this run are left out
+    :return:
+    """
+    rows = []
+    for filename in filenames:
+        path = '{0}{1}/profile'.format(params["output_dir"], filename)
+        if os.path.isfile(path + '.json') and os.path.getmtime(path + '.json') >= since:
+            rows += slideseg3.readtimings(path)
+    slideseg3.writetimings('{0}profile'.format(params["output_dir"]), rows)
+    print('{0:.2f} core hours in {1} slides'.format(sum(row[5] for row in rows) / 3600,
+                                                    len(set(row[0] for row in rows))))
+
+
+def main(convert, queue=None):
     """
     Runs SlideSeg with the parameters specified in Parameters.txt
-    :return: image chips and masks
+    :param convert: only converts the annotation masks to tiff if true
+    :param queue: cohort queue file shared by several jobs, slides are processed by this job alone if None
+    :return: image chips and masks, and the number of slides of the cohort queue that failed
     """
     params = slideseg3.load_parameters('Parameters.txt')
     print('running __main__ with parameters: {0}'.format(params))
+    if queue and not convert:
+        return cohort.main(params, queue)
+
     if not os.path.isdir(params["slide_path"]):
         path, filename = os.path.split(params["slide_path"])
         xpath, xml_filename = os.path.split(params["xml_path"])
@@ -26,20 +137,20 @@ def main(convert):
 
     else:
         start = timeit.default_timer()
-        # for filename in os.listdir(params["slide_path"]):
-            # print(filename)
-            # slideseg3.run(params, filename)
+        since = time.time()
+        # Slides run at the same time while they fit the memory budget, each
+        # using its share of the cpus through the worker processes of slideseg3.run
         print(params["cpus"])
-        pool = Pool(int(params["cpus"]))
-
-        for filename in os.listdir(params["slide_path"]):
-            pool.apply_async(Run, args=(params, filename, convert,))
-        pool.close()
-        pool.join()
+        print('{0} annotation keys in {1}'.format(slideseg3.preparekeys(params), params["xml_path"]))
+        schedule(params, os.listdir(params["slide_path"]), convert)
+        if not convert and params.get("profile", "none") in ('report', 'cprofile'):
+            writeprofile(params, os.listdir(params["slide_path"]), since)
 
         print('get whole takes:',timeit.default_timer() - start)
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--mask", help="Only Convert mask to tiff(default is false)")
+    parser.add_argument("--queue", help="Cohort queue file shared by jobs on several nodes (SQLite, on a shared filesystem)")
     args = parser.parse_args()
-    main(args.mask)
+    if main(args.mask, args.queue):
+        sys.exit(1)
@@ -27,18 +27,37 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
-import sys
 from PIL import Image
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from openslide import OpenSlide
 import xml.etree.ElementTree as ET
 import numpy as np
 import tqdm
 import cv2
 import os
-import timeit
+import shutil
+import tempfile
+import threading
+import queue
+import hashlib
+import tarfile
+import json
+import time
+import io
+import csv
+import cProfile
+from contextlib import contextmanager
+from functools import lru_cache
 from multiprocessing.dummy import Pool as ThreadPool
-from multiprocessing import Value
+from multiprocessing import Process, Queue, Pool
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
 
 def load_parameters(parameters):
     """
@@ -60,62 +79,707 @@ def load_parameters(parameters):
     return params
 
 
-def makemask(annotation_key, size, xml_path):
+def makemask(annotation_key, size, xml_path, dims=None, max_pixels=2 ** 28):
     """
-    Reads xml file and makes annotation mask for entire slide image
+    Reads xml file and makes annotation mask for entire slide image.
+    The mask is kept as vector data (one contour per region) and is only
+    rasterized for the windows requested through rastermask. When the level
+    dimensions are given, a nearest neighbour mask pyramid is also built
+    for the lower magnification levels
     :param annotation_key: name of the annotation key file
     :param size: size of the whole slide image
     :param xml_path: path to the xml file
+    :param dims: dimensions of every level of the slide image
+    :param max_pixels: largest pyramid level kept in memory, larger levels
+                       are sampled from the polygons for each chip
     :return: annotation mask
     :return: dictionary of annotation keys and color codes
     """
 
-    # Import xml file and get root
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-
-    # Generate annotation array and key dictionary
-    # memory cost
-    mat = np.zeros((size[1], size[0]), dtype='uint8')
+    # Generate annotation key dictionary and region lists
     annotations = defaultdict(list)
     contours = []
+    codes = []
+    bboxes = []
 
-    # Find data in xml file
+    # Find data in xml file. main.py generates the key before running any
+    # slide (see preparekeys), slides run on their own generate it here
     if not os.path.isfile(annotation_key):
-        print(("Could not find {0}, generating new file...".format(annotation_key)))
-        generatekey('{0}'.format(annotation_key), os.path.split(xml_path)[0])
-        print(('{0} generated.'.format(annotation_key)))
+        with keylock(annotation_key):
+            if not os.path.isfile(annotation_key):
+                print(("Could not find {0}, generating new file...".format(annotation_key)))
+                generatekey('{0}'.format(annotation_key), os.path.split(xml_path)[0] or '.')
+                print(('{0} generated.'.format(annotation_key)))
+                _registry.pop(annotation_key, None)
 
-    color_codes = loadkeys(annotation_key)
+    with timed('xml') as timing:
+        regions = readregions(xml_path)
+        timing['bytes'] = os.path.getsize(xml_path)
+    color_codes = registerkeys(annotation_key, [key for key, _ in regions])
+
+    for key, points in regions:
+        color_code = color_codes[key]
 
-    size = 0
-    for reg in root.iter('Region'):
-        key = reg.get('Text').upper()
-        if key in color_codes:
-            color_code = color_codes[key][0]
-        else:
-            addkeys(annotation_key, key)
-            color_codes = loadkeys(annotation_key)
-            color_codes = color_codes[key][0]
-
-        points = []
-        for child in reg.iter('Vertices'):
-            for vert in child.iter('Vertex'):
-                x = int(round(float(vert.get('X'))))
-                y = int(round(float(vert.get('Y'))))
-                points.append((x, y))
-
-        cnt = np.array(points).reshape((-1, 1, 2)).astype(np.int32)
-        cv2.fillPoly(mat, [cnt], color_code)
-        contours.append(cnt)
-        # print('{} mat size is '.format(sys.getsizeof(mat)))
-        size = size + sys.getsizeof(cnt) + sys.getsizeof(mat) + sys.getsizeof(points)
         # annotations and colors
         if key not in annotations:
             annotations['{0}'.format(key)].append(color_code)
-    # print('{} total size is {}'.format(xml_path,size/10**10))
+
+        if len(points) == 0:
+            continue
+
+        cnt = points.reshape((-1, 1, 2))
+        contours.append(cnt)
+        codes.append(color_code)
+        bboxes.append((cnt[:, 0, 0].min(), cnt[:, 0, 1].min(),
+                       cnt[:, 0, 0].max() + 1, cnt[:, 0, 1].max() + 1))
+
+    bboxes = np.array(bboxes, dtype=np.int64).reshape((-1, 4))
+    mask = {'size': (int(size[0]), int(size[1])),
+            'contours': contours,
+            'codes': np.array(codes, dtype='uint8'),
+            'bboxes': bboxes,
+            'bucket': 4096,
+            'index': indexregions(bboxes, 4096),
+            'dims': [(int(size[0]), int(size[1]))] if dims is None else [tuple(map(int, dim)) for dim in dims],
+            'pyramid': {}}
+    with timed('pyramid') as timing:
+        buildpyramid(mask, max_pixels)
+        timing['bytes'] = sum(level.nbytes for level in mask['pyramid'].values())
+
     print('annotations loaded successfully')
-    return mat, annotations
+    return mask, annotations
+
+
+def parseregions(xml_path):
+    """
+    Streams the regions out of an xml file, clearing each region once it is read
+    :param xml_path: path to the xml file
+    :return: list of (key, vertices) regions, vertices are rounded to int32 (n, 2) arrays
+    """
+    regions = []
+    xs, ys = [], []
+    for _, elem in ET.iterparse(xml_path):
+        if elem.tag == 'Vertex':
+            xs.append(elem.get('X'))
+            ys.append(elem.get('Y'))
+        elif elem.tag == 'Region':
+            # parse the coordinates in one go, rounded like round(float(x))
+            points = np.empty((len(xs), 2), dtype=np.int32)
+            points[:, 0] = np.rint(np.array(xs, dtype=np.float64))
+            points[:, 1] = np.rint(np.array(ys, dtype=np.float64))
+            regions.append((elem.get('Text').upper(), points))
+            xs, ys = [], []
+            elem.clear()
+    return regions
+
+
+def parsekeys(xml_path):
+    """
+    Streams the keys out of an xml file, reading only the Text attribute of
+    each region and clearing each region once it is read
+    :param xml_path: path to the xml file
+    :return: list of the distinct keys, in order of first appearance
+    """
+    keys = []
+    for event, elem in ET.iterparse(xml_path, events=('start', 'end')):
+        if elem.tag != 'Region':
+            continue
+        if event == 'start':
+            keys.append(elem.get('Text').upper())
+        else:
+            elem.clear()
+    return list(OrderedDict.fromkeys(keys))
+
+
+def loadcache(xml_path, suffix):
+    """
+    Opens the on-disk cache of an xml file (.cache/<name><suffix>) if it was
+    written for the current size and modification time of the xml file
+    :param xml_path: path to the xml file
+    :param suffix: suffix of the cache file
+    :return: dictionary of the cached arrays, or None if there is no valid cache
+    """
+    directory, filename = os.path.split(xml_path)
+    cache_path = os.path.join(directory, '.cache', filename + suffix)
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as cache:
+            if np.array_equal(cache['stamp'], xmlstamp(xml_path)):
+                return dict((name, cache[name]) for name in cache.files)
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def savecache(xml_path, suffix, **arrays):
+    """
+    Writes the on-disk cache of an xml file, see loadcache
+    :param xml_path: path to the xml file
+    :param suffix: suffix of the cache file
+    :param arrays: arrays to cache
+    :return:
+    """
+    directory, filename = os.path.split(xml_path)
+    cache_path = os.path.join(directory, '.cache', filename + suffix)
+    try:
+        ensuredirectory(os.path.dirname(cache_path))
+        # write then rename, so concurrent runs never read a partial cache
+        temp_path = '{0}.{1}.npz'.format(cache_path[:-4], os.getpid())
+        np.savez(temp_path, stamp=xmlstamp(xml_path), **arrays)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        # the xml folder may be read only, the results are just not cached
+        pass
+
+
+def xmlstamp(xml_path):
+    """
+    Identifies the version of an xml file for its on-disk caches
+    :param xml_path: path to the xml file
+    :return: int64 array of its size and modification time
+    """
+    stat = os.stat(xml_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def readregions(xml_path):
+    """
+    Reads the regions of an xml file, from an on-disk cache next to it
+    (.cache/<name>.npz) while the xml file is unchanged
+    :param xml_path: path to the xml file
+    :return: list of (key, vertices) regions, see parseregions
+    """
+    cache = loadcache(xml_path, '.npz')
+    if cache is not None:
+        offsets = cache['offsets']
+        points = cache['points']
+        return [(str(key), points[start:stop])
+                for key, start, stop in zip(cache['keys'], offsets[:-1], offsets[1:])]
+
+    regions = parseregions(xml_path)
+
+    offsets = np.cumsum([0] + [len(points) for _, points in regions]).astype(np.int64)
+    points = np.concatenate([points for _, points in regions]) if regions else np.zeros((0, 2), np.int32)
+    savecache(xml_path, '.npz', keys=np.array([key for key, _ in regions], dtype=str),
+              offsets=offsets, points=points)
+    return regions
+
+
+def readkeys(xml_path):
+    """
+    Reads the distinct keys of an xml file, from its region cache or from a
+    key cache next to it (.cache/<name>.keys.npz) while the xml file is unchanged
+    :param xml_path: path to the xml file
+    :return: list of the distinct keys, in order of first appearance
+    """
+    for suffix in ('.npz', '.keys.npz'):
+        cache = loadcache(xml_path, suffix)
+        if cache is not None:
+            return list(OrderedDict.fromkeys(str(key) for key in cache['keys']))
+
+    keys = parsekeys(xml_path)
+    savecache(xml_path, '.keys.npz', keys=np.array(keys, dtype=str))
+    return keys
+
+
+def scankeys(path, cpus=1):
+    """
+    Reads the keys of every xml file of a folder, with cpus processes
+    :param path: directory containing xml files
+    :param cpus: number of processes
+    :return: list of the distinct keys, in order of first appearance in the
+             xml files sorted by filename
+    """
+    paths = [os.path.join(path, filename) for filename in sorted(os.listdir(path)) if filename.endswith('.xml')]
+    if cpus > 1 and len(paths) > 1:
+        pool = Pool(min(cpus, len(paths)))
+        try:
+            found = pool.map(readkeys, paths, chunksize=max(1, len(paths) // (4 * cpus)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        found = [readkeys(xml_path) for xml_path in paths]
+
+    return list(OrderedDict.fromkeys(key for file_keys in found for key in file_keys))
+
+
+def _clipline(width, height, x1, y1, x2, y2):
+    """
+    Clips a line to an image the way cv2.clipLine does, before OpenCV walks
+    the outline of a polygon
+    :param width: width of the image
+    :param height: height of the image
+    :param x1: x of the first point
+    :param y1: y of the first point
+    :param x2: x of the second point
+    :param y2: y of the second point
+    :return: whether any of the line is inside the image, and the clipped points
+    """
+    right, bottom = width - 1, height - 1
+    c1 = (x1 < 0) + (x1 > right) * 2 + (y1 < 0) * 4 + (y1 > bottom) * 8
+    c2 = (x2 < 0) + (x2 > right) * 2 + (y2 < 0) * 4 + (y2 > bottom) * 8
+
+    if (c1 & c2) == 0 and (c1 | c2) != 0:
+        if c1 & 12:
+            a = 0 if c1 < 8 else bottom
+            x1 += int(float(a - y1) * (x2 - x1) / (y2 - y1))
+            y1 = a
+            c1 = (x1 < 0) + (x1 > right) * 2
+        if c2 & 12:
+            a = 0 if c2 < 8 else bottom
+            x2 += int(float(a - y2) * (x2 - x1) / (y2 - y1))
+            y2 = a
+            c2 = (x2 < 0) + (x2 > right) * 2
+        if (c1 & c2) == 0 and (c1 | c2) != 0:
+            if c1:
+                a = 0 if c1 == 1 else right
+                y1 += int(float(a - x1) * (y2 - y1) / (x2 - x1))
+                x1 = a
+                c1 = 0
+            if c2:
+                a = 0 if c2 == 1 else right
+                y2 += int(float(a - x2) * (y2 - y1) / (x2 - x1))
+                x2 = a
+                c2 = 0
+
+    return (c1 | c2) == 0, x1, y1, x2, y2
+
+
+def _fillregion(mat, cnt, code, x, y, size):
+    """
+    Draws one annotation region into a window of the slide mask, pixel for
+    pixel the same as cv2.fillPoly on the full slide mask. OpenCV clips
+    polygons to the image it draws on, which moves the boundary pixels of
+    regions crossing the image edge, so those regions are drawn here from
+    their edges clipped to the slide, not to the window, with the same fixed
+    point scanline fill and 8-connected outline
+    :param mat: uint8 window of the slide mask
+    :param cnt: region contour of shape (n, 1, 2)
+    :param code: color code of the region
+    :param x: left edge of the window in the slide
+    :param y: top edge of the window in the slide
+    :param size: width and height of the slide
+    :return: mat with the region drawn
+    """
+    height, width = mat.shape
+    pts = cnt.reshape((-1, 2)).astype(np.int64)
+
+    # Regions inside the window are not clipped by OpenCV
+    if (pts[:, 0].min() >= x and pts[:, 0].max() < x + width and
+            pts[:, 1].min() >= y and pts[:, 1].max() < y + height):
+        cv2.fillPoly(mat, [cnt], int(code), offset=(-x, -y))
+        return mat
+
+    x0, y0 = np.roll(pts, 1, axis=0).T
+    x1, y1 = pts.T
+
+    # Edges leaving the slide are clipped to it like cv2.clipLine: the
+    # outline is drawn between the clipped points, and the fill follows the
+    # clipped x, with the clipped y where the clipped line is not flat
+    cx0, cy0, cx1, cy1 = x0.copy(), y0.copy(), x1.copy(), y1.copy()
+    drawn = np.ones(len(x0), dtype=bool)
+    outside = ((np.minimum(x0, x1) < 0) | (np.maximum(x0, x1) >= size[0]) |
+               (np.minimum(y0, y1) < 0) | (np.maximum(y0, y1) >= size[1]))
+    for idx in np.flatnonzero(outside):
+        drawn[idx], cx0[idx], cy0[idx], cx1[idx], cy1[idx] = _clipline(
+            size[0], size[1], int(x0[idx]), int(y0[idx]), int(x1[idx]), int(y1[idx]))
+    clipped = cy0 != cy1
+    sx0, sy0 = cx0, np.where(clipped, cy0, y0)
+    sx1, sy1 = cx1, np.where(clipped, cy1, y1)
+
+    # Scanline fill between pairs of edge crossings (16 bit fixed point)
+    fill = y0 != y1
+    if np.count_nonzero(fill) >= 2:
+        ey0, ey1 = y0[fill], y1[fill]
+        fx0, fy0, fx1, fy1 = sx0[fill], sy0[fill], sx1[fill], sy1[fill]
+        num = (fx1 - fx0) << 16
+        den = fy1 - fy0
+        dx = np.sign(num) * np.sign(den) * (np.abs(num) // np.abs(den))
+        top = np.minimum(ey0, ey1)
+        start = np.where(ey0 < ey1, (fx0 << 16) + (ey0 - fy0) * dx, (fx1 << 16) + (ey1 - fy1) * dx)
+        first = np.maximum(top, y)
+        count = np.maximum(np.minimum(np.maximum(ey0, ey1), y + height) - first, 0)
+        if count.sum() > 0:
+            edge = np.repeat(np.arange(len(count)), count)
+            rows = first[edge] + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+            xs = start[edge] + (rows - top[edge]) * dx[edge]
+            order = np.lexsort((xs, rows))
+            rows, xs = rows[order], xs[order]
+            left = np.maximum((xs[0::2] + 0xFFFF) >> 16, x) - x
+            right = np.minimum(xs[1::2] >> 16, x + width - 1) - x
+            rows = rows[0::2] - y
+            keep = left <= right
+            spans = np.stack([left[keep], rows[keep], right[keep], rows[keep]], axis=1)
+            if len(spans) > 0:
+                cv2.polylines(mat, list(spans.reshape((-1, 2, 1, 2)).astype(np.int32)), False, int(code))
+
+    # Outline, walked left to right like cv2.line, only where the major
+    # coordinate of each line is inside the window
+    x0, y0, x1, y1 = cx0[drawn], cy0[drawn], cx1[drawn], cy1[drawn]
+    swap = x1 < x0
+    lx0, ly0 = np.where(swap, x1, x0), np.where(swap, y1, y0)
+    lx1, ly1 = np.where(swap, x0, x1), np.where(swap, y0, y1)
+    step = np.where(ly1 < ly0, -1, 1)
+    vert = np.abs(ly1 - ly0) > lx1 - lx0
+    major = np.where(vert, np.abs(ly1 - ly0), lx1 - lx0)
+    minor = np.where(vert, lx1 - lx0, np.abs(ly1 - ly0))
+    lo = np.where(vert, np.where(step > 0, y - ly0, ly0 - (y + height - 1)), x - lx0)
+    hi = np.where(vert, np.where(step > 0, y + height - 1 - ly0, ly0 - y), x + width - 1 - lx0)
+    lo = np.maximum(lo, 0)
+    count = np.maximum(np.minimum(hi, major) - lo + 1, 0)
+    if count.sum() > 0:
+        line = np.repeat(np.arange(len(count)), count)
+        k = lo[line] + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        m = -((major[line] - 2 * minor[line] * k) // np.maximum(2 * major[line], 1))
+        px = np.where(vert[line], lx0[line] + m, lx0[line] + k)
+        py = np.where(vert[line], ly0[line] + step[line] * k, ly0[line] + step[line] * m)
+        inside = (px >= x) & (px < x + width) & (py >= y) & (py < y + height)
+        mat[py[inside] - y, px[inside] - x] = code
+
+    return mat
+
+
+def indexregions(bboxes, bucket):
+    """
+    Builds a grid bucket index over the bounding boxes of annotation regions
+    :param bboxes: region bounding boxes (x0, y0, x1, y1), x1 and y1 exclusive
+    :param bucket: size of the square grid buckets in pixels
+    :return: dictionary of grid buckets and the regions touching them
+    """
+    index = defaultdict(list)
+    for idx, (x0, y0, x1, y1) in enumerate(bboxes):
+        for gx in range(x0 // bucket, (x1 - 1) // bucket + 1):
+            for gy in range(y0 // bucket, (y1 - 1) // bucket + 1):
+                index[(gx, gy)].append(idx)
+    return index
+
+
+def queryregions(mask, x, y, width, height):
+    """
+    Finds the annotation regions whose bounding box overlaps a window
+    :param mask: annotation mask returned by makemask
+    :param x: left edge of the window
+    :param y: top edge of the window
+    :param width: width of the window
+    :param height: height of the window
+    :return: region indices in xml order
+    """
+    bucket = mask['bucket']
+    found = set()
+    for gx in range(x // bucket, (x + width - 1) // bucket + 1):
+        for gy in range(y // bucket, (y + height - 1) // bucket + 1):
+            found.update(mask['index'].get((gx, gy), ()))
+    if len(found) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    hits = np.array(sorted(found), dtype=np.int64)
+    bboxes = mask['bboxes'][hits]
+    return hits[(bboxes[:, 0] < x + width) & (bboxes[:, 2] > x) &
+                (bboxes[:, 1] < y + height) & (bboxes[:, 3] > y)]
+
+
+def clipwindow(mask, x, y, width, height):
+    """
+    Clips a window to the slide, as when slicing a full slide mask array
+    :param mask: annotation mask returned by makemask
+    :param x: left edge of the window
+    :param y: top edge of the window
+    :param width: width of the window
+    :param height: height of the window
+    :return: clipped x, y, width and height
+    """
+    slide_width, slide_height = mask['size']
+    x = max(int(x), 0)
+    y = max(int(y), 0)
+    width = max(min(int(width), slide_width - x), 0)
+    height = max(min(int(height), slide_height - y), 0)
+    return x, y, width, height
+
+
+def rastermask(mask, x, y, width, height):
+    """
+    Rasterizes the annotation mask for a window of the slide at level 0.
+    Windows reaching past the slide border are clipped
+    :param mask: annotation mask returned by makemask
+    :param x: left edge of the window
+    :param y: top edge of the window
+    :param width: width of the window
+    :param height: height of the window
+    :return: uint8 annotation mask for the window
+    """
+    x, y, width, height = clipwindow(mask, x, y, width, height)
+    mat = np.zeros((height, width), dtype='uint8')
+    if width == 0 or height == 0:
+        return mat
+
+    # Only draw regions whose bounding box touches the window, in xml order
+    for idx in queryregions(mask, x, y, width, height):
+        _fillregion(mat, mask['contours'][idx], mask['codes'][idx], x, y, mask['size'])
+
+    return mat
+
+
+def gridlabels(mask, grids, cpus=1):
+    """
+    Finds the color codes present in every window of one or more chip grids
+    at once. Each axis is cut at every window edge into blocks, the
+    annotated tiles of the slide are rasterized once and reduced to the
+    codes present in each block, and summed-area tables over the blocks
+    give the codes present in each window
+    :param mask: annotation mask returned by makemask
+    :param grids: list of (x_starts, x_ends, y_starts, y_ends) window edge
+                  arrays at level 0, one entry per chip grid
+    :param cpus: number of threads rasterizing tiles
+    :return: array of color codes
+    :return: list of boolean arrays (code, x window, y window), one per grid
+    """
+    slide_width, slide_height = mask['size']
+    codes = np.unique(mask['codes'])
+    codes = codes[codes > 0]
+
+    bounds = []
+    blocks = []
+    for x_starts, x_ends, y_starts, y_ends in grids:
+        bound_x = np.unique(np.concatenate((x_starts, np.minimum(x_ends, slide_width))))
+        bound_y = np.unique(np.concatenate((y_starts, np.minimum(y_ends, slide_height))))
+        bounds.append((bound_x, bound_y))
+        blocks.append(np.zeros((len(codes), len(bound_y) - 1, len(bound_x) - 1), dtype=bool))
+
+    def _tilelabels(tile):
+        bucket = mask['bucket']
+        x, y, width, height = clipwindow(mask, tile[0] * bucket, tile[1] * bucket, bucket, bucket)
+        mat = rastermask(mask, x, y, width, height)
+        counts = np.bincount(mat.ravel(), minlength=256)
+        results = []
+        for c in np.flatnonzero(counts[codes]):
+            hit = mat == codes[c]
+            for g, (bound_x, bound_y) in enumerate(bounds):
+                x_end = min(x + width, bound_x[-1])
+                y_end = min(y + height, bound_y[-1])
+                if x_end <= x or y_end <= y:
+                    continue
+                cut_x = np.concatenate(([x], bound_x[(bound_x > x) & (bound_x < x_end)]))
+                cut_y = np.concatenate(([y], bound_y[(bound_y > y) & (bound_y < y_end)]))
+                found = np.logical_or.reduceat(hit[:y_end - y, :x_end - x], cut_x - x, axis=1)
+                found = np.logical_or.reduceat(found, cut_y - y, axis=0)
+                results.append((g, c, np.searchsorted(bound_y, cut_y, 'right') - 1,
+                                np.searchsorted(bound_x, cut_x, 'right') - 1, found))
+        return results
+
+    pool = ThreadPool(cpus)
+    for results in pool.imap_unordered(_tilelabels, list(mask['index'].keys())):
+        for g, c, block_y, block_x, found in results:
+            blocks[g][c][np.ix_(block_y, block_x)] |= found
+    pool.close()
+    pool.join()
+
+    presence = []
+    for (x_starts, x_ends, y_starts, y_ends), (bound_x, bound_y), found in zip(grids, bounds, blocks):
+        table = np.zeros((len(codes), len(bound_y), len(bound_x)), dtype=np.int64)
+        table[:, 1:, 1:] = found.cumsum(axis=1).cumsum(axis=2)
+        x0 = np.searchsorted(bound_x, x_starts)[:, None]
+        x1 = np.searchsorted(bound_x, np.minimum(x_ends, slide_width))[:, None]
+        y0 = np.searchsorted(bound_y, y_starts)[None, :]
+        y1 = np.searchsorted(bound_y, np.minimum(y_ends, slide_height))[None, :]
+        count = table[:, y1, x1] - table[:, y0, x1] - table[:, y1, x0] + table[:, y0, x0]
+        presence.append(count > 0)
+
+    return codes, presence
+
+
+def samplepoints(mask, level, start, count, axis):
+    """
+    Finds the level 0 pixels sampled by nearest neighbour for a range of
+    pixels of a pyramid level
+    :param mask: annotation mask returned by makemask
+    :param level: slide level
+    :param start: first pixel of the range at the level
+    :param count: number of pixels in the range
+    :param axis: 0 for columns, 1 for rows
+    :return: level 0 pixel coordinates
+    """
+    scale = float(mask['dims'][0][axis]) / mask['dims'][level][axis]
+    points = np.floor((np.arange(start, start + count) + 0.5) * scale).astype(np.int64)
+    return np.minimum(points, mask['dims'][0][axis] - 1)
+
+
+def buildpyramid(mask, max_pixels):
+    """
+    Builds the nearest neighbour mask of every lower magnification level
+    that fits in max_pixels, rasterizing each annotated tile of the slide once
+    :param mask: annotation mask returned by makemask
+    :param max_pixels: largest level kept in memory
+    :return: mask with the pyramid levels added
+    """
+    levels = []
+    for level, (width, height) in enumerate(mask['dims']):
+        if level > 0 and width * height <= max_pixels:
+            mask['pyramid'][level] = np.zeros((height, width), dtype='uint8')
+            levels.append((level, samplepoints(mask, level, 0, width, 0),
+                           samplepoints(mask, level, 0, height, 1)))
+    if len(levels) == 0:
+        return mask
+
+    bucket = mask['bucket']
+    for gx, gy in mask['index']:
+        x, y, width, height = clipwindow(mask, gx * bucket, gy * bucket, bucket, bucket)
+        if width == 0 or height == 0:
+            continue
+        tile = rastermask(mask, x, y, width, height)
+        for level, points_x, points_y in levels:
+            col0, col1 = np.searchsorted(points_x, [x, x + width])
+            row0, row1 = np.searchsorted(points_y, [y, y + height])
+            if col1 > col0 and row1 > row0:
+                mask['pyramid'][level][row0:row1, col0:col1] = tile[np.ix_(points_y[row0:row1] - y,
+                                                                          points_x[col0:col1] - x)]
+    return mask
+
+
+def levelmask(mask, level, x, y, width, height, max_pixels=2 ** 24):
+    """
+    Reads a window of the annotation mask at the resolution of a slide level,
+    from the mask pyramid or sampled from the polygons
+    :param mask: annotation mask returned by makemask
+    :param level: slide level
+    :param x: left edge of the window at the level
+    :param y: top edge of the window at the level
+    :param width: width of the window
+    :param height: height of the window
+    :param max_pixels: largest level 0 window rasterized at once when sampling
+                       from the polygons, larger windows are sampled in bands of rows
+    :return: uint8 annotation mask for the window, clipped to the level
+    """
+    if level == 0:
+        return rastermask(mask, x, y, width, height)
+
+    level_width, level_height = mask['dims'][level]
+    x = max(int(x), 0)
+    y = max(int(y), 0)
+    width = max(min(int(width), level_width - x), 0)
+    height = max(min(int(height), level_height - y), 0)
+    if width == 0 or height == 0:
+        return np.zeros((height, width), dtype='uint8')
+
+    if level in mask['pyramid']:
+        return mask['pyramid'][level][y:y + height, x:x + width]
+
+    points_x = samplepoints(mask, level, x, width, 0)
+    points_y = samplepoints(mask, level, y, height, 1)
+    span_x = points_x[-1] - points_x[0] + 1
+    span_y = float(points_y[-1] - points_y[0] + 1) / height
+    band = max(1, int(max_pixels // (span_x * span_y)))
+
+    mat = np.zeros((height, width), dtype='uint8')
+    for start in range(0, height, band):
+        rows = points_y[start:start + band]
+        window = rastermask(mask, points_x[0], rows[0], span_x, rows[-1] - rows[0] + 1)
+        mat[start:start + len(rows)] = window[np.ix_(rows - rows[0], points_x - points_x[0])]
+    return mat
+
+
+def writemasktiff(mask, path, cpus=1, mpp=None, tile=256):
+    """
+    Writes the annotation mask as a tiled, zlib compressed, pyramidal BigTIFF
+    with a page for every slide level, as read by OpenSlide and QuPath. Tiles
+    are rasterized by cpus threads a few at a time and written as they come,
+    so the memory used does not depend on the size of the slide
+    :param mask: annotation mask returned by makemask
+    :param path: path to the tiff file
+    :param cpus: number of threads
+    :param mpp: microns per pixel of level 0, written as the resolution if given
+    :param tile: tile size
+    :return:
+    """
+    if tifffile is None:
+        raise ImportError('tifffile is required to write the mask tiff')
+
+    pool = ThreadPool(cpus)
+
+    def masktile(level, x, y):
+        window = levelmask(mask, level, x, y, tile, tile)
+        if window.shape != (tile, tile):
+            window = np.pad(window, ((0, tile - window.shape[0]), (0, tile - window.shape[1])), 'constant')
+        return window
+
+    def leveltiles(level):
+        width, height = mask['dims'][level]
+        corners = ((x, y) for y in range(0, height, tile) for x in range(0, width, tile))
+        while True:
+            batch = [corner for _, corner in zip(range(4 * cpus), corners)]
+            if not batch:
+                return
+            for window in pool.map(lambda corner: masktile(level, *corner), batch):
+                yield window
+
+    try:
+        with tifffile.TiffWriter(path + '.tmp', bigtiff=True) as tiff:
+            for level, (width, height) in enumerate(mask['dims']):
+                resolution = None
+                if mpp:
+                    scale = float(mask['dims'][0][0]) / width
+                    # pixels per inch, the default resolution unit
+                    resolution = (25400 / (float(mpp) * scale), 25400 / (float(mpp) * scale))
+                # tiles are compressed as they come, tifffile buffers hundreds of MB
+                # of tiles to compress them with several threads
+                tiff.write(leveltiles(level), shape=(height, width), dtype='uint8', tile=(tile, tile),
+                           photometric='minisblack', compression='zlib', maxworkers=1,
+                           subfiletype=0 if level == 0 else 1, resolution=resolution, metadata=None)
+    finally:
+        pool.close()
+    os.replace(path + '.tmp', path)
+
+
+def sharemask(mask, directory):
+    """
+    Writes the arrays of an annotation mask to .npy files, so that worker
+    processes memory map them instead of receiving a pickled copy
+    :param mask: annotation mask returned by makemask
+    :param directory: directory for the mask files
+    :return: dictionary describing the shared mask, for loadmask
+    """
+    lengths = [len(cnt) for cnt in mask['contours']]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    if len(mask['contours']) > 0:
+        points = np.concatenate([cnt.reshape((-1, 2)) for cnt in mask['contours']])
+    else:
+        points = np.zeros((0, 2), dtype=np.int32)
+
+    np.save(os.path.join(directory, 'points.npy'), points.astype(np.int32))
+    np.save(os.path.join(directory, 'offsets.npy'), offsets)
+    np.save(os.path.join(directory, 'codes.npy'), mask['codes'])
+    np.save(os.path.join(directory, 'bboxes.npy'), mask['bboxes'])
+    for level, mat in mask['pyramid'].items():
+        np.save(os.path.join(directory, 'level{0}.npy'.format(level)), mat)
+
+    return {'directory': directory,
+            'size': mask['size'],
+            'bucket': mask['bucket'],
+            'dims': mask['dims'],
+            'levels': list(mask['pyramid'].keys())}
+
+
+def loadmask(shared):
+    """
+    Memory maps an annotation mask written by sharemask
+    :param shared: dictionary describing the shared mask
+    :return: annotation mask
+    """
+    directory = shared['directory']
+    points = np.load(os.path.join(directory, 'points.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(directory, 'offsets.npy'))
+    bboxes = np.load(os.path.join(directory, 'bboxes.npy'))
+
+    return {'size': shared['size'],
+            'contours': [points[start:stop].reshape((-1, 1, 2)) for start, stop in zip(offsets[:-1], offsets[1:])],
+            'codes': np.load(os.path.join(directory, 'codes.npy')),
+            'bboxes': bboxes,
+            'bucket': shared['bucket'],
+            'index': indexregions(bboxes, shared['bucket']),
+            'dims': shared['dims'],
+            'pyramid': dict((level, np.load(os.path.join(directory, 'level{0}.npy'.format(level)), mmap_mode='r'))
+                            for level in shared['levels'])}
 
 
 def writekeys(filename, annotations):
@@ -141,22 +805,26 @@ def writekeys(filename, annotations):
     file.close()
 
 
-def writeimagelist(filename, image_dictionary):
+def writeimagelist(filename, chips):
     """
     Writes list of images containing each annotation key
     :param filename: the name of the slide image
-    :param image_dictionary: dictionary of images with each key
+    :param chips: chip plan, from getchips
     :return text
     """
     dest = 'output/textfiles/'
     name = '{0}_{1}'.format(os.path.splitext(filename)[0], 'Details')
     file = open("{0}{1}.txt".format(dest, name), "a")
 
-    for key, value in image_dictionary.items():
-        keyline = "\nKey: {0}\n".format(key)
+    # keys in the order of the first chip containing them
+    labels = chips['table']['labels']
+    found = [np.flatnonzero(labels[:, index // 8] & (1 << index % 8)) for index in range(len(chips['keys']))]
+    for index in sorted((index for index in range(len(found)) if len(found[index])), key=lambda index: found[index][0]):
+        keyline = "\nKey: {0}\n".format(chips['keys'][index])
         file.write(keyline)
-        for name in value:
-            file.write("   {0}\n".format(name))
+        for start in range(0, len(found[index]), 65536):
+            for name in chipnames(chips, found[index][start:start + 65536]):
+                file.write("   {0}\n".format(name))
     file.close()
 
 
@@ -179,6 +847,66 @@ def loadkeys(annotation_key):
     return color_codes
 
 
+# Color codes of every annotation key file used by this process
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def keyregistry(annotation_key):
+    """
+    Gets the color codes of an annotation key file, read once per process.
+    Codes never change once assigned, so they are looked up in memory
+    :param annotation_key: the filename of the annotation key
+    :return: color codes
+    """
+    with _registry_lock:
+        if annotation_key not in _registry:
+            _registry[annotation_key] = loadkeys(annotation_key) if os.path.isfile(annotation_key) \
+                else defaultdict(list)
+        return _registry[annotation_key]
+
+
+@contextmanager
+def keylock(annotation_key):
+    """
+    Holds the lock of an annotation key file, shared by the threads of this
+    process and, through flock on annotation_key.lock, by other processes
+    :param annotation_key: the filename of the annotation key
+    :return:
+    """
+    with _registry_lock, open(annotation_key + '.lock', 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def registerkeys(annotation_key, keys):
+    """
+    Looks up the color codes of keys, adding unknown keys to the annotation key.
+    Unknown keys are added in sorted order below the lowest code in use, while
+    holding a lock on the annotation key, so processes running slides at the
+    same time never give two keys the same code or lose a key
+    :param annotation_key: the filename of the annotation key
+    :param keys: keys to look up
+    :return: dictionary of keys and color codes
+    """
+    color_codes = keyregistry(annotation_key)
+    missing = sorted(set(key for key in keys if key not in color_codes))
+
+    if missing:
+        with keylock(annotation_key):
+            # keys may have been added by other processes since the file was read
+            color_codes = loadkeys(annotation_key) if os.path.isfile(annotation_key) else defaultdict(list)
+            for key in missing:
+                if key not in color_codes:
+                    used = [value[0] for value in color_codes.values()]
+                    color_codes[key].append(min(used) - 1 if used else 255)
+            writeannotations(annotation_key, color_codes)
+            _registry[annotation_key] = color_codes
+
+    return dict((key, color_codes[key][0]) for key in keys)
+
+
 def addkeys(annotation_key, key):
     """
     Adds new key and color_code to annotation key
@@ -187,11 +915,7 @@ def addkeys(annotation_key, key):
     :return: updated annotation key file
     """
 
-    color_codes = loadkeys(annotation_key)
-    min_color = min(list(color_codes.items()), key = lambda x: x[1])[1]
-    new_color = int(min_color[0]) - 1
-    color_codes[key.upper()].append(new_color)
-    writeannotations(annotation_key, color_codes)
+    registerkeys(annotation_key, [key.upper()])
 
 
 def writeannotations(annotation_key, annotations):
@@ -201,54 +925,121 @@ def writeannotations(annotation_key, annotations):
     :param annotations: Dictionary of annotation keys and color codes
     :return: .txt file with annotation keys
     """
-    file = open(annotation_key, "w+")
+    # write then rename, so other processes never read a partial file
+    temp_path = '{0}.{1}.tmp'.format(annotation_key, os.getpid())
+    file = open(temp_path, "w+")
 
     for key, value in sorted(annotations.items()):
         keyline = "Key: {0}".format(key)
         file.write(keyline)
         file.write(("Mask_Color: {0}\n".format(value).rjust(65 - len(keyline))))
     file.close()
+    os.replace(temp_path, annotation_key)
 
 
-def generatekey(annotation_key, path):
+def generatekey(annotation_key, path, cpus=1):
     """
     Generates annotation_key from folder of xml files
     :param annotation_key: the name of the annotation key file
     :param path: Directory containing xml files
+    :param cpus: number of processes reading the xml files
     :return: annotation_key file
     """
 
-    color = 256
+    # codes count down from 255 in order of first appearance
     annotations = defaultdict(list)
-    for filename in os.listdir(path):
-        # Import xml file and get root
-        tree = ET.parse('{0}/{1}'.format(path, filename))
-        root = tree.getroot()
-
-        # Find data in xml file
-        for reg in root.iter('Region'):
-            key = reg.get('Text').upper()
-            if key in annotations:
-                continue
-            else:
-                color -= 1
-                color_code = color
-
-            if key not in annotations:
-                annotations['{0}'.format(key)].append(color_code)
+    for index, key in enumerate(scankeys(path, cpus)):
+        annotations[key].append(255 - index)
 
     # print annotations to text file
     writeannotations(annotation_key, annotations)
 
 
+def preparekeys(parameters):
+    """
+    Finds the keys of every xml file of xml_path once, before any slide is run,
+    so slides run at the same time (or by cohort workers on several nodes) find
+    their keys in the annotation key instead of racing to add them. Generates
+    the annotation key if there is none, or adds the keys it is missing
+    :param parameters: specified in Parameters.txt file
+    :return: number of distinct keys in the xml files
+    """
+    annotation_key = parameters["key"]
+    path = parameters["xml_path"] or '.'
+    cpus = int(parameters.get("cpus", 1))
+
+    with keylock(annotation_key):
+        if not os.path.isfile(annotation_key):
+            print("Could not find {0}, generating new file...".format(annotation_key))
+            generatekey(annotation_key, path, cpus)
+            print('{0} generated.'.format(annotation_key))
+            _registry.pop(annotation_key, None)
+            return len(loadkeys(annotation_key))
+
+    return len(registerkeys(annotation_key, scankeys(path, cpus)))
+
+
 def ensuredirectory(dest):
     """
     Ensures the existence of a directory
     :param dest: Directory to ensure.
     :return: new directory if it did not previously exist.
     """
-    if not os.path.exists(dest):
-        os.makedirs(dest)
+    os.makedirs(dest, exist_ok=True)
+
+
+def keydirectories(output_dir, keys):
+    """
+    Creates the tag based subfolders of a slide once, before any chip is written
+    :param output_dir: output directory of the slide
+    :param keys: keys directory names of the chips
+    :return:
+    """
+    for keysDir in set(keys):
+        for directory in ('image_chips', 'image_mask'):
+            ensuredirectory('{0}{1}/{2}'.format(output_dir, keysDir, directory))
+
+
+def writefile(path, data, policy='none'):
+    """
+    Writes an encoded chip or mask to a directory that already exists
+    :param path: path of the file
+    :param data: encoded bytes
+    :param policy: 'none' leaves the file to the page cache, 'dontneed' drops it
+                   from the page cache once written (scratch storage read back
+                   later by other nodes), 'fsync' waits until it is on disk
+    :return:
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        if policy == 'fsync':
+            os.fsync(fd)
+        elif policy == 'dontneed' and hasattr(os, 'posix_fadvise'):
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+@lru_cache(maxsize=None)
+def imagetags(keys):
+    """
+    Builds the image tags for a set of keys once, chips and masks with the same keys share them
+    :param keys: tuple of keys to attach as tags
+    :return: EXIF bytes for JPG/PNG and TIFF tags for TIFF outputs
+    """
+
+    import piexif
+
+    description = ' '.join(keys)
+    exif_bytes = piexif.dump({"0th": {piexif.ImageIFD.ImageDescription: description}})
+
+    # tags written by the LZW encoder of OpenCV, followed by the description
+    tiff_tags = {277: 1, 317: 2, 270: description}
+    return exif_bytes, tiff_tags
 
 
 def attachtags(path, keys):
@@ -256,27 +1047,49 @@ def attachtags(path, keys):
     Attaches image tags to metadata of chips and masks
     :param path: file to attach tags to.
     :param keys: keys to attach as tags
-    :return: JPG with metadata tags
+    :return: EXIF bytes with the metadata tags, None for PNG
     """
 
-    if os.path.splitext(path)[1] == ".png":
-        pass
+    if path.endswith(".png"):
+        return None
+    else:
+        return imagetags(tuple(keys))[0]
+
+
+def writechip(chip, fp, suffix, quality, keys):
+    """
+    Encodes the image chip with its tags
+    :param chip: the slide image chip to save
+    :param fp: path or file object to write to
+    :param suffix: file suffix of the output format
+    :param quality: the output quality
+    :param keys: keys associated with the chip
+    :return:
+    """
+    chip.save(fp, format=Image.registered_extensions()['.' + suffix], quality=quality,
+              exif=attachtags('.' + suffix, keys))
+
+
+def writemask(mask, fp, suffix, keys):
+    """
+    Encodes the image mask with its tags
+    :param mask: the image mask to save
+    :param fp: path or file object to write to
+    :param suffix: file suffix of the output format
+    :param keys: keys associated with the chip
+    :return:
+    """
+    format = Image.registered_extensions()['.' + suffix]
+
+    if suffix == 'jpg':
+        Image.fromarray(mask).save(fp, format=format, quality=100, exif=attachtags('.' + suffix, keys))
+
+    elif suffix in ('tif', 'tiff'):
+        Image.fromarray(mask).save(fp, format=format, compression='tiff_lzw', tiffinfo=imagetags(tuple(keys))[1])
+
     else:
-        # import pexif
-        import piexif
-
-        # metadata = pexif.JpegFile.fromFile(path)
-        str = ' '.join(keys)
-        exif_ifd = {
-            piexif.ImageIFD.ImageDescription: str
-        }
-        # metadata.exif.primary.ImageDescription = str
-        # output = open(path, "wb")
-        # metadata.writeFd(output)
-        # output.close()
-        exif_dict = {"0th": exif_ifd}
-        exif_bytes = piexif.dump(exif_dict)
-        return exif_bytes
+        Image.fromarray(mask).save(fp, format=format, exif=attachtags('.' + suffix, keys))
+
 
 def savechip(chip, path, quality, keys):
     """
@@ -293,28 +1106,12 @@ def savechip(chip, path, quality, keys):
     ensuredirectory(directory)
     format, suffix = formatcheck(os.path.splitext(filename)[1].strip('.'))
 
+    # Save image chip with its tags in one pass
+    writechip(chip, path, suffix, quality, keys)
+
     if suffix == 'jpg':
-        # Save image chip
-        exif_bytes = attachtags(path, keys)
-        chip.save(path, quality = quality, exif=exif_bytes)
         print('chip path:', path)
-        # Attach image tags
-        # attachtags(path, keys)
 
-    else:
-        # Save image chip
-        exif_bytes = attachtags(path, keys)
-        chip.save(path, quality = quality, exif=exif_bytes)
-
-        # Attach image tags
-        # attachtags(path, keys)
-
-# def saveEntiremask(mask, path):
-#     directory, filename = os.path.split(path)
-#     ensuredirectory(directory)
-#     # print(mask.dtype)
-#     # print(type(mask))
-#     cv2.imwrite(path, mask)
 
 def savemask(mask, path, keys):
     """
@@ -330,46 +1127,194 @@ def savemask(mask, path, keys):
     ensuredirectory(directory)
     format, suffix = formatcheck(os.path.splitext(filename)[1].strip('.'))
 
-    if suffix == 'jpg':
-        # Save the image mask
-        cv2.imwrite(path, mask, [cv2.IMWRITE_JPEG_QUALITY, 100])
+    # Save the image mask with its tags in one pass
+    writemask(mask, path, suffix, keys)
 
-        exif_bytes = attachtags(path, keys)
-        mask = Image.open(path)
-        mask.save(path, exif=exif_bytes)
+    if suffix == 'jpg':
         print('mask path:', path)
-        # Attach image tags
-        # attachtags(path, keys)
 
-    else:
-        # Save the image mask
-        cv2.imwrite(path, mask)
 
-        exif_bytes = attachtags(path, keys)
-        mask = Image.open(path)
-        mask.save(path, exif=exif_bytes)
-        # Attach image tags
-        # attachtags(path, keys)
+def writeshards(samples, directory, prefix, shard_size):
+    """
+    Streams encoded chips and masks into tar shards readable by WebDataset style
+    loaders. Each sample is stored as <chip name>.<suffix> (chip),
+    <chip name>.mask.<suffix> (mask) and <chip name>.json (keys, level, row, col).
+    A tab separated index of chip names, shards and keys is written next to the shards
+    :param samples: iterable of (chip name, keys, level, col, row, chip bytes, mask bytes)
+    :param directory: output directory of the shards
+    :param prefix: file name prefix of the shards
+    :param shard_size: maximum number of chips in each shard
+    :return: number of chips written
+    """
+    ensuredirectory(directory)
+
+    def addmember(shard, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        shard.addfile(info, io.BytesIO(data))
+
+    shard = None
+    count = 0
+    with open(os.path.join(directory, '{0}_index.txt'.format(prefix)), 'w') as index:
+        try:
+            for name, keys, level, col, row, chip, mask in samples:
+                if count % shard_size == 0:
+                    if shard is not None:
+                        shard.close()
+                    shard_name = '{0}-{1:06d}.tar'.format(prefix, count // shard_size)
+                    shard = tarfile.open(os.path.join(directory, shard_name), 'w')
+
+                stem, suffix = os.path.splitext(name)
+                label = {'keys': list(keys), 'level': int(level), 'row': int(row), 'col': int(col)}
+                addmember(shard, name, chip)
+                addmember(shard, '{0}.mask{1}'.format(stem, suffix), mask)
+                addmember(shard, '{0}.json'.format(stem), json.dumps(label).encode())
+                index.write('{0}\t{1}\t{2}\n'.format(name, shard_name, ' '.join(keys)))
+                count += 1
+        finally:
+            if shard is not None:
+                shard.close()
+
+    return count
+
+
+def inputsdigest(parameters, paths):
+    """
+    Digest of everything the output of a slide depends on
+    :param parameters: specified in Parameters.txt file
+    :param paths: slide image, xml file and annotation key paths
+    :return: hex digest
+    """
+    digest = hashlib.md5(repr([parameters.get(name) for name in (
+        "format", "quality", "size", "overlap", "save_all", "save_ratio", "level", "min_tissue",
+        "output_type", "shard_size", "sample_seed", "sample_by_level")]).encode())
+
+    slide_path, xml_path, key_path = paths
+    stat = os.stat(slide_path)
+    digest.update('{0} {1} {2}'.format(os.path.basename(slide_path), stat.st_size, stat.st_mtime_ns).encode())
+    if os.path.isfile(xml_path):
+        with open(xml_path, 'rb') as file:
+            digest.update(file.read())
+        # only the codes of the keys of this slide, the annotation key is
+        # shared with every slide and grows with the keys of other xml files
+        color_codes = loadkeys(key_path) if os.path.isfile(key_path) else {}
+        digest.update(repr([(key, color_codes.get(key)) for key in sorted(readkeys(xml_path))]).encode())
+    return digest.hexdigest()
+
+
+def chipdigests(mask, chips, chip_size, identity):
+    """
+    Content digest of each chip, from the slide identity and output settings,
+    the position and keys of the chip, and the annotation regions overlapping
+    it. A chip is only affected by an annotation edit if one of its regions
+    changed
+    :param mask: annotation mask, from makemask
+    :param chips: chip plan, from getchips
+    :param chip_size: the size of the image chips
+    :param identity: string identifying the slide and the output settings
+    :return: array of the hex digests of the chips in the plan table (bytes)
+    """
+    regions = [hashlib.md5(bytes([int(code)]) + cnt.tobytes()).digest()
+               for cnt, code in zip(mask['contours'], mask['codes'])]
+
+    keysets, keyset = chipkeys(chips)
+    table = chips['table']
+    digests = np.zeros(len(table), dtype='S32')
+    # chip names and positions are formatted in batches
+    for start in range(0, len(table), 65536):
+        batch = slice(start, start + 65536)
+        for index, name, keys, level, col, row in zip(
+                range(start, len(table)), chipnames(chips, batch), keyset[batch].tolist(),
+                table['level'][batch].tolist(), table['col'][batch].tolist(), table['row'][batch].tolist()):
+            keys = keysets[keys]
+            scale_width, scale_height = chips['scales'][level]
+
+            # level 0 footprint of the chip, widened by one pixel of its level
+            x = int(np.floor((col - 1) * scale_width))
+            y = int(np.floor((row - 1) * scale_height))
+            width = int(np.ceil((chip_size + 2) * scale_width))
+            height = int(np.ceil((chip_size + 2) * scale_height))
+
+            digest = hashlib.md5('{0}\t{1}\t{2}'.format(identity, name, ' '.join(keys)).encode())
+            for region in queryregions(mask, x, y, width, height):
+                digest.update(regions[region])
+            digests[index] = digest.hexdigest().encode()
+    return digests
+
+
+def loadjournal(path):
+    """
+    Loads the journal of a slide, which records every chip whose chip and mask
+    were written with its content digest, and a final line once the slide was
+    finished
+    :param path: path to the journal
+    :return: dictionary of chip names and (digest, keys directory), and the
+             inputs digest of the finished slide or None
+    """
+    written, complete = {}, None
+    if not os.path.isfile(path):
+        return written, complete
+
+    with open(path) as journal:
+        for line in journal:
+            # a line cut short by preemption has no newline and is ignored
+            if not line.endswith('\n'):
+                break
+            line = line.rstrip('\n')
+            if line.startswith('complete '):
+                complete = line.split(' ')[1]
+            else:
+                digest, name, keysDir = line.split('\t')
+                written[name] = (digest, keysDir)
+    return written, complete
 
 
-def checksave(save_all, pix_list, save_ratio, save_count_annotated, save_count_blank):
+def startjournal(path, written):
+    """
+    Starts a new journal of a slide for appending written chips
+    :param path: path to the journal
+    :param written: dictionary of chip names and (digest, keys directory) still valid from the last run
+    :return: journal file
     """
-    Checks whether or not an image chip should be saved
+    ensuredirectory(os.path.dirname(path))
+    with open(path + '.tmp', 'w') as journal:
+        for name, (digest, keysDir) in written.items():
+            journal.write('{0}\t{1}\t{2}\n'.format(digest, name, keysDir))
+    os.replace(path + '.tmp', path)
+    return open(path, 'a')
+
+
+def checksave(save_all, annotated, levels, save_ratio, seed=0, stratify=False):
+    """
+    Checks which image chips should be saved, over every candidate chip of a
+    slide at once. Annotated chips are always saved, and blank chips are
+    sampled at random so that annotated chips outnumber them by save_ratio
     :param save_all: (bool) saves all chips if true
-    :param pix_list: list of pixel values in image mask
+    :param annotated: boolean array, true for chips containing an annotated pixel
+    :param levels: slide level of each chip
     :param save_ratio: ratio of annotated chips to unannotated chips
-    :param save_count_annotated: total annotated chips saved
-    :param save_count_blank: total blank chips saved
-    :return: bool
+    :param seed: seed of the sampling, the same seed and chips give the same sample
+    :param stratify: (bool) balances the chips of every level on its own if true
+    :return: boolean array of chips to save
     """
+    annotated = np.asarray(annotated, dtype=bool)
     if save_all is True:
-        save = True
-    elif save_count_annotated / float(save_count_blank) > save_ratio:
-        save = True
-    elif len([x for x in pix_list if x > 0]) > 0:
-        save = True
-    else:
-        save = False
+        return np.ones(len(annotated), dtype=bool)
+
+    levels = np.asarray(levels)
+    strata = [levels == i for i in np.unique(levels)] if stratify else [np.ones(len(annotated), dtype=bool)]
+
+    save = annotated.copy()
+    rng = np.random.default_rng(seed)
+    for stratum in strata:
+        blank = np.flatnonzero(stratum & ~annotated)
+        count = np.count_nonzero(stratum & annotated)
+        if save_ratio <= 0:
+            sample = len(blank)
+        else:
+            sample = min(len(blank), int(count / save_ratio))
+        save[rng.choice(blank, sample, replace=False)] = True
 
     return save
 
@@ -443,22 +1388,152 @@ def openwholeslide(path):
     return osr, levels, dims, availableMag
 
 
+def tissuemask(osr, levels, dims):
+    """
+    Detects tissue on the lowest magnification level of a slide with an
+    Otsu threshold on the saturation, cleaned up by morphological closing
+    and opening
+    :param osr: slide image
+    :param levels: levels in whole slide image
+    :param dims: dimension of whole slide image
+    :return: uint8 tissue map at the lowest level (1 = tissue)
+    """
+    thumbnail = np.asarray(osr.read_region([0, 0], levels - 1, dims[levels - 1]).convert('RGB'))
+    saturation = cv2.cvtColor(thumbnail, cv2.COLOR_RGB2HSV)[:, :, 1]
+    _, tissue = cv2.threshold(saturation, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    tissue = cv2.morphologyEx(tissue, cv2.MORPH_CLOSE, kernel)
+    tissue = cv2.morphologyEx(tissue, cv2.MORPH_OPEN, kernel)
+    return tissue
+
+
+def tissuefraction(tissue, size, x_starts, x_ends, y_starts, y_ends):
+    """
+    Computes the tissue fraction of every window of a chip grid from an
+    integral image of the tissue map
+    :param tissue: tissue map from tissuemask
+    :param size: size of the whole slide image at level 0
+    :param x_starts: left edges of the windows at level 0
+    :param x_ends: right edges of the windows at level 0
+    :param y_starts: top edges of the windows at level 0
+    :param y_ends: bottom edges of the windows at level 0
+    :return: array of tissue fractions (x window, y window)
+    """
+    height, width = tissue.shape
+    table = cv2.integral(tissue)
+
+    def _cells(starts, ends, slide_size, map_size):
+        first = np.clip((starts * map_size) // slide_size, 0, map_size - 1)
+        last = np.clip(-((-ends * map_size) // slide_size), first + 1, map_size)
+        return first, last
+
+    x0, x1 = _cells(x_starts, x_ends, size[0], width)
+    y0, y1 = _cells(y_starts, y_ends, size[1], height)
+    x0, x1 = x0[:, None], x1[:, None]
+    y0, y1 = y0[None, :], y1[None, :]
+    count = table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+    return count / ((x1 - x0) * (y1 - y0)).astype(float)
+
+
+def tilesize(osr, level):
+    """
+    Gets the size of the native tiles of a slide level
+    :param osr: slide image
+    :param level: slide level
+    :return: tile width and height (256 if the slide does not report it)
+    """
+    width = osr.properties.get('openslide.level[{0}].tile-width'.format(level), 256)
+    height = osr.properties.get('openslide.level[{0}].tile-height'.format(level), 256)
+    return int(width), int(height)
+
+
+def estimatememory(parameters, filename, convert=False):
+    """
+    Estimates the peak memory of running a slide, before opening its annotations.
+    The estimate is split into the main process (mask pyramid, polygons,
+    tissue mask and chip plan) and each worker process (slide region,
+    chip and mask encoding, and the encoded chips queued for tar shards)
+    :param parameters: specified in Parameters.txt file
+    :param filename: filename of whole slide image
+    :param convert: only converts the annotation mask to tiff if true
+    :return: bytes of the main process, and bytes of each worker process
+    """
+    _chip_size = int(parameters["size"])
+    _overlap = int(parameters["overlap"])
+    _read_size = int(parameters.get("read_size", 4096))
+    _min_tissue = float(parameters.get("min_tissue", 0))
+
+    _osr, _levels, _dims, availableMag = openwholeslide('{0}{1}'.format(parameters["slide_path"], filename))
+    tile_width, tile_height = tilesize(_osr, 0)
+    _osr.close()
+
+    # python, numpy, opencv and openslide of any process
+    process = 200 * 2 ** 20
+
+    xml_path = '{0}{1}.xml'.format(parameters["xml_path"], filename.rstrip(".svs"))
+    xml_size = os.path.getsize(xml_path) if os.path.isfile(xml_path) else 0
+
+    # the mask tiff is written tile by tile from the polygons: the element tree
+    # of the xml file, and a level 0 band and a few tiles for every thread
+    if convert:
+        return process + 4 * xml_size + int(parameters["cpus"]) * 2 ** 25, 0
+
+    # nearest neighbour pyramid of the lower levels (uint8), polygons and
+    # the element tree of the xml file
+    main = process + sum(width * height for width, height in _dims[1:] if width * height <= 2 ** 28)
+    main += 4 * xml_size
+
+    # tissue mask of the lowest level: RGBA, HSV and thresholded saturation
+    if _min_tissue > 0:
+        main += _dims[-1][0] * _dims[-1][1] * 9
+
+    # chip plan: grids, labels and sampling of every chip of every level, and
+    # the plan table, digests and lookups of the saved chips
+    stride = max(1, _chip_size - _overlap)
+    chips = sum((width // stride + 1) * (height // stride + 1) for width, height in _dims)
+    main += chips * 100
+
+    _read_threads, _mask_threads, _encode_threads, _write_threads = [
+        int(parameters.get(name, 1)) for name in ("read_threads", "mask_threads", "encode_threads", "write_threads")]
+    _queue_size = int(parameters.get("queue_size", 4))
+
+    # regions being read as RGBA and RGB, rounded up to the native tiles,
+    # regions queued for or being cut into chips, chips and masks queued for
+    # or being encoded and written, openslide's tile cache of each slide
+    # handle, and the decoded tile cache
+    read_width = -(-(_read_size + _chip_size) // tile_width) * tile_width
+    read_height = -(-(_read_size + _chip_size) // tile_height) * tile_height
+    worker = process + read_width * read_height * (7 * _read_threads + 3 * (_queue_size + _mask_threads))
+    worker += _chip_size * _chip_size * 8 * (_encode_threads + _write_threads + 2 * _queue_size)
+    worker += 32 * 2 ** 20 * _read_threads
+    worker += float(parameters.get("tile_cache", 0)) * 2 ** 20
+
+    # encoded chips and masks waiting for the shard writer
+    if parameters.get("output_type", "files") == 'tar':
+        worker += _chip_size * _chip_size * 8 * _queue_size
+
+    return main, worker
+
+
 def curatemask(mask, scale_width, scale_height, chip_size):
     """
-    Resize and pad annotation mask if necessary
+    Resize and pad annotation mask if necessary. Resizing uses the nearest
+    neighbour so that only valid color codes end up in the mask
     :param mask: an image mask
     :param scale_width: scaling for higher magnification levels
     :param scale_height: scaling for higher magnification levels
     :return: curated annotation mask
     """
     # Resize and pad annotation mask if necessary
-    mask = cv2.resize(mask, None, fx=float(1) / scale_width, fy=float(1) / scale_height,
-                      interpolation=cv2.INTER_CUBIC)
+    if scale_width != 1 or scale_height != 1:
+        mask = cv2.resize(mask, None, fx=float(1) / scale_width, fy=float(1) / scale_height,
+                          interpolation=cv2.INTER_NEAREST)
 
     mask_width, mask_height = mask.shape
     if mask_height < chip_size or mask_width < chip_size:
-        mask = np.pad(mask, ((0, chip_size - mask_width),
-                                       (0, chip_size - mask_height)), 'constant')
+        mask = np.pad(mask, ((0, max(chip_size - mask_width, 0)),
+                             (0, max(chip_size - mask_height, 0))), 'constant')
 
     if mask_height > chip_size or mask_width > chip_size:
         mask = mask[:chip_size, :chip_size]
@@ -466,7 +1541,8 @@ def curatemask(mask, scale_width, scale_height, chip_size):
     return mask
 
 
-def getchips(levels, dims, chip_size, overlap, mask, annotations, filename, suffix, save_all, save_ratio, cpus, level=None):
+def getchips(levels, dims, chip_size, overlap, mask, annotations, filename, suffix, save_all, save_ratio, cpus, level=None,
+             tissue=None, min_tissue=0, seed=0, stratify=False):
     """
     Finds chip locations that should be loaded and saved
 
@@ -480,84 +1556,820 @@ def getchips(levels, dims, chip_size, overlap, mask, annotations, filename, suff
     :param suffix: output format for saving.
     :param save_all: whether or not to save every image chip (bool)
     :param save_ratio: ratio of annotated to unannotated chips (float)
-    :return: chip_dict. Dictionary of chip names, level, col, row, and scale
-    :return: image_dict. Dictionary of annotations and chips with those annotations
-    """
-    _save_count_blank = Value("d",1)
-    _save_count_annotated = Value("d",1)
-    def _getchips(_save_count_blank,_save_count_annotated,i):
-        image_dict = defaultdict(list)
-        chip_dict = defaultdict(list)
+    :param tissue: tissue map from tissuemask, chips without annotations are
+                   skipped when their tissue fraction is below min_tissue
+    :param min_tissue: minimum tissue fraction of unannotated chips (float)
+    :param seed: seed of the unannotated chips sampled for save_ratio (int)
+    :param stratify: samples save_ratio on every level on its own (bool)
+    :return: chip plan, see chipplan
+    """
+    if level == levels:
+        print('processing all levels...')
+        scan_levels = list(range(levels))
+    else:
+        print('processing level {0}'.format(level + 1))
+        scan_levels = [level]
+
+    # Chip grid of every level and its windows in the level 0 mask
+    grids = []
+    windows = []
+    for i in scan_levels:
         width, height = dims[i]
         scale_factor_width = float(dims[0][0]) / width
         scale_factor_height = float(dims[0][1]) / height
+        cols = np.arange(0, width, chip_size - overlap)
+        rows = np.arange(0, height, chip_size - overlap)
+        grids.append((cols, rows, scale_factor_width, scale_factor_height))
+        windows.append(((cols * scale_factor_width).astype(np.int64),
+                        ((cols + chip_size) * scale_factor_width).astype(np.int64),
+                        (rows * scale_factor_height).astype(np.int64),
+                        ((rows + chip_size) * scale_factor_height).astype(np.int64)))
+
+    codes, presence = gridlabels(mask, windows, cpus)
+
+    # Keys of each color code, in annotation order
+    key_codes = [(key, np.flatnonzero(codes == int(value[0]))) for key, value in annotations.items()]
+
+    # Chips are scanned column by column
+    presence = [found.reshape((len(codes), found.shape[1] * found.shape[2])) for found in presence]
+    annotated = np.concatenate([found.any(axis=0) for found in presence])
+    chip_levels = np.concatenate([np.full(found.shape[1], i) for i, found in zip(scan_levels, presence)])
+
+    # Skip unannotated chips on background glass
+    candidates = np.ones(len(annotated), dtype=bool)
+    if tissue is not None and min_tissue > 0:
+        candidates = annotated | (np.concatenate([tissuefraction(tissue, dims[0], *window).ravel()
+                                                  for window in windows]) >= min_tissue)
+        print('{0} chips skipped as background'.format(len(candidates) - np.count_nonzero(candidates)))
+
+    # Blank chips are sampled over the whole slide before any pixels are read,
+    # seeded by the slide name so every slide gets its own reproducible sample
+    slide_seed = int(hashlib.md5(filename.encode()).hexdigest()[:8], 16)
+    save = np.zeros(len(annotated), dtype=bool)
+    save[candidates] = checksave(save_all, annotated[candidates], chip_levels[candidates], save_ratio,
+                                 [seed, slide_seed], stratify)
+    saves = np.split(save, np.cumsum([found.shape[1] for found in presence])[:-1])
+
+    table = []
+    for i, (cols, rows, _, _), found, save in zip(scan_levels, grids, presence, saves):
         print(('Scanning slide level {0} of {1}'.format(i + 1, levels)))
+        cells = np.flatnonzero(save)
 
-        # Generate the image chip coordinates and save information
-        for col in tqdm.tqdm(list(range(0, width, chip_size - overlap))):
-            for row in range(0, height, chip_size - overlap):
-                img_mask = mask[int(row * scale_factor_height):int((row + chip_size) * scale_factor_height),
-                           int(col * scale_factor_width):int((col + chip_size) * scale_factor_width)]
-                # memory cost
-                pix_list = np.unique(img_mask)
-                # Check whether or not to save the region
-                save = checksave(save_all, pix_list, save_ratio, _save_count_annotated.value, _save_count_blank.value)
-                # Save image and assign keys.
-                if save is True:
-                    chip_name = '{0}_{1}_{2}_{3}.{4}'.format(filename.rstrip('.svs'), i, row, col, suffix)
-                    keys = []
-
-                    # Make sure annotation key contains value
-                    for key, value in annotations.items():
-                        for pixel in pix_list:
-                            if int(pixel) == int(value[0]):
-                                keys.append(key)
-                                image_dict[key].append(chip_name)
-
-                    if len(keys) == 0:
-                        _save_count_blank.value += 1
-                        keys.append('NONE')
-                    else:
-                        _save_count_annotated.value += 1
-
-                    chip_dict[chip_name] = [keys]
-                    chip_dict[chip_name].append(i)
-                    chip_dict[chip_name].append(col)
-                    chip_dict[chip_name].append(row)
-                    chip_dict[chip_name].append(scale_factor_width)
-                    chip_dict[chip_name].append(scale_factor_height)
-        return image_dict, chip_dict
-    if level == levels:
-        print('processing all levels...')
-        results = []
+        # keys of each chip, in annotation order
+        labels = np.zeros((len(cells), len(key_codes)), dtype=bool)
+        for index, (_, key_code) in enumerate(key_codes):
+            labels[:, index] = found[key_code][:, cells].any(axis=0)
+
+        chips = np.zeros(len(cells), dtype=chipdtype(len(key_codes)))
+        chips['level'] = i
+        chips['col'] = cols[cells // len(rows)]
+        chips['row'] = rows[cells % len(rows)]
+        if key_codes:
+            chips['labels'] = np.packbits(labels, axis=1, bitorder='little')
+        table.append(chips)
+
+    return {'prefix': filename.rstrip('.svs'),
+            'suffix': suffix,
+            'keys': [key for key, _ in key_codes],
+            'scales': [(float(dims[0][0]) / width, float(dims[0][1]) / height) for width, height in dims],
+            'table': np.concatenate(table)}
+
+
+def chipdtype(keys):
+    """
+    Row of the chip plan table: level, col and row of the chip in its level,
+    and a bitmask of its annotation keys
+    :param keys: number of annotation keys
+    :return: numpy structured dtype
+    """
+    return np.dtype([('level', 'u1'), ('col', 'i4'), ('row', 'i4'), ('labels', 'u1', (max(1, -(-keys // 8)),))])
+
+
+def chipnames(chips, indices):
+    """
+    Formats the names of chips of a chip plan
+    :param chips: chip plan, from getchips
+    :param indices: indices of the chips in the plan table
+    :return: list of chip names
+    """
+    table = chips['table'][indices]
+    return ['{0}_{1}_{2}_{3}.{4}'.format(chips['prefix'], level, row, col, chips['suffix'])
+            for level, row, col in zip(table['level'].tolist(), table['row'].tolist(), table['col'].tolist())]
+
+
+def chipkeys(chips):
+    """
+    Gets the distinct key sets of the chips of a chip plan, computed once per plan
+    :param chips: chip plan, from getchips
+    :return: list of key lists (['NONE'] for chips without annotations), and
+             the index of the key set of every chip
+    """
+    if 'keysets' not in chips:
+        labels, keyset = np.unique(chips['table']['labels'], axis=0, return_inverse=True)
+        bits = np.unpackbits(labels, axis=1, count=len(chips['keys']), bitorder='little')
+        chips['keysets'] = [[key for key, bit in zip(chips['keys'], row) if bit] or ['NONE'] for row in bits]
+        chips['keyset'] = keyset.reshape(-1)
+    return chips['keysets'], chips['keyset']
+
+
+def chipindex(chips, names):
+    """
+    Finds chips of a chip plan by name. The plan table is sorted by level, col
+    and row, as getchips scans the chips
+    :param chips: chip plan, from getchips
+    :param names: chip names
+    :return: index of every chip in the plan table, -1 for chips not in the plan
+    """
+    if 'lookup' not in chips:
+        table = chips['table']
+        chips['lookup'] = ((table['level'].astype(np.int64) << 58) | (table['col'].astype(np.int64) << 29)
+                           | table['row'].astype(np.int64))
+
+    found = np.zeros(len(names), dtype=np.int64)
+    for index, name in enumerate(names):
+        level, row, col = os.path.splitext(name)[0].rsplit('_', 3)[1:]
+        found[index] = (int(level) << 58) | (int(col) << 29) | int(row)
+    indices = np.searchsorted(chips['lookup'], found)
+    valid = indices < len(chips['lookup'])
+    valid[valid] = chips['lookup'][indices[valid]] == found[valid]
+    return np.where(valid, indices, -1)
+
+
+def shareplan(chips, directory):
+    """
+    Writes the table of a chip plan to a .npy file, so that worker processes
+    and the text reports memory map it
+    :param chips: chip plan, from getchips
+    :param directory: directory for the plan file
+    :return: dictionary describing the shared plan, for loadplan
+    """
+    np.save(os.path.join(directory, 'chips.npy'), chips['table'])
+    return {'directory': directory,
+            'prefix': chips['prefix'],
+            'suffix': chips['suffix'],
+            'keys': chips['keys'],
+            'scales': chips['scales']}
+
+
+def loadplan(shared):
+    """
+    Memory maps a chip plan written by shareplan
+    :param shared: dictionary describing the shared plan
+    :return: chip plan
+    """
+    return {'prefix': shared['prefix'],
+            'suffix': shared['suffix'],
+            'keys': shared['keys'],
+            'scales': [tuple(scale) for scale in shared['scales']],
+            'table': np.load(os.path.join(shared['directory'], 'chips.npy'), mmap_mode='r')}
+
+
+def readchips(chips, read):
+    """
+    Gets the chips of a region read
+    :param chips: chip plan, from getchips
+    :param read: (level, x, y, width, height, chip indices) region, from planreads
+    :return: (level, x, y, width, height, chips) region, see readregion
+    """
+    level, x, y, width, height, indices = read
+    indices = np.asarray(indices, dtype=np.int64)
+    keysets, keyset = chipkeys(chips)
+    scale_width, scale_height = chips['scales'][level]
+    table = chips['table'][indices]
+    return (level, x, y, width, height,
+            [[name, keysets[keys], level, col, row, scale_width, scale_height]
+             for name, keys, col, row in zip(chipnames(chips, indices), keyset[indices].tolist(),
+                                             table['col'].tolist(), table['row'].tolist())])
+
+
+def planreads(chips, chip_size, read_size, tile_sizes):
+    """
+    Groups chips into large regions that are read from the slide once. Chips
+    are grouped by the read_size block their corner falls in, and each region
+    starts on the native tile grid of its level. Blocks with chips left out of
+    the plan (background or unsampled) are read in the runs of planned chips
+    around them, see chipruns
+    :param chips: chip plan, from getchips
+    :param chip_size: the size of the image chips
+    :param read_size: size of the read blocks at each level
+    :param tile_sizes: native tile width and height of each level
+    :return: list of (level, x, y, width, height, chip indices) regions, in the
+             order of their first chip
+    """
+    table = chips['table']
+    if len(table) == 0:
+        return []
+
+    levels = table['level'].astype(np.int64)
+    cols = table['col'].astype(np.int64)
+    rows = table['row'].astype(np.int64)
+    tiles = np.array(tile_sizes, dtype=np.int64)
+    tile_width, tile_height = tiles[levels, 0], tiles[levels, 1]
+    block_width = np.maximum(tile_width, read_size // tile_width * tile_width)
+    block_height = np.maximum(tile_height, read_size // tile_height * tile_height)
+
+    blocks = np.stack([levels, cols // block_width, rows // block_height], axis=1)
+    _, first, block = np.unique(blocks, axis=0, return_index=True, return_inverse=True)
+    block = block.reshape(-1)
+    groups = np.split(np.argsort(block, kind='stable'), np.cumsum(np.bincount(block))[:-1])
+
+    reads = []
+    for index in np.argsort(first):
+        level = int(levels[groups[index][0]])
+        tile_width, tile_height = tile_sizes[level]
+        for indices in chipruns(cols, rows, groups[index], chip_size):
+            x = int(cols[indices].min()) // tile_width * tile_width
+            y = int(rows[indices].min()) // tile_height * tile_height
+            reads.append((level, x, y, int(cols[indices].max()) + chip_size - x,
+                          int(rows[indices].max()) + chip_size - y, indices))
+    return reads
+
+
+def chipruns(cols, rows, indices, chip_size, waste=0.125):
+    """
+    Splits the chips of a read block into regions that leave out the pixels
+    of chips missing from the plan (background or unsampled). A block whose
+    chips fill its grid is read whole; otherwise each chip row is cut where
+    the next chip does not touch the previous one, and runs are joined with
+    the runs of the rows above while at most waste of the region is outside
+    its chips
+    :param cols: column of every chip of the plan
+    :param rows: row of every chip of the plan
+    :param indices: indices of the chips of the block, in plan order
+    :param chip_size: the size of the image chips
+    :param waste: largest share of a region outside its chips
+    :return: list of arrays of chip indices, in plan order
+    """
+    block_cols, block_rows = cols[indices], rows[indices]
+    if len(np.unique(block_cols)) * len(np.unique(block_rows)) == len(indices):
+        return [indices]
+
+    def covered(members):
+        # area of the union of the chips, over the grid of their edges
+        xs, ys = block_cols[members], block_rows[members]
+        edges_x = np.unique(np.concatenate((xs, xs + chip_size)))
+        edges_y = np.unique(np.concatenate((ys, ys + chip_size)))
+        x0, x1 = np.searchsorted(edges_x, xs), np.searchsorted(edges_x, xs + chip_size)
+        y0, y1 = np.searchsorted(edges_y, ys), np.searchsorted(edges_y, ys + chip_size)
+        count = np.zeros((len(edges_y), len(edges_x)), dtype=np.int64)
+        for y, x, sign in ((y0, x0, 1), (y0, x1, -1), (y1, x0, -1), (y1, x1, 1)):
+            np.add.at(count, (y, x), sign)
+        inside = count.cumsum(axis=0).cumsum(axis=1)[:-1, :-1] > 0
+        return int((inside * np.diff(edges_y)[:, None] * np.diff(edges_x)[None, :]).sum())
+
+    bands = []
+    order = np.lexsort((block_cols, block_rows))
+    start = 0
+    for end in range(1, len(order) + 1):
+        if end < len(order) and block_rows[order[end]] == block_rows[order[end - 1]] and \
+                block_cols[order[end]] - block_cols[order[end - 1]] <= chip_size:
+            continue
+        run = order[start:end]
+        start = end
+        row, left, right = block_rows[run[0]], block_cols[run[0]], block_cols[run[-1]] + chip_size
+
+        # the touching region above that stays fullest with the run added
+        best, best_area = None, 0
+        for band in bands:
+            if row - band['row'] > chip_size or right <= band['left'] or left >= band['right']:
+                continue
+            members = np.concatenate((band['members'], run))
+            area = (max(right, band['right']) - min(left, band['left'])) * (row + chip_size - band['top'])
+            used = covered(members)
+            if area - used <= waste * area and (best is None or used * best_area > best[1] * area):
+                best, best_area = (band, used), area
+        if best is None:
+            bands.append({'top': row, 'row': row, 'left': left, 'right': right, 'members': run})
+        else:
+            band = best[0]
+            band.update(row=row, left=min(left, band['left']), right=max(right, band['right']),
+                        members=np.concatenate((band['members'], run)))
+
+    return sorted((np.sort(indices[band['members']]) for band in bands), key=lambda members: members[0])
+
+
+def tilecache(capacity):
+    """
+    Creates a least recently used cache of decoded slide tiles, shared by the
+    read threads of a worker across the chips and levels of a slide
+    :param capacity: size of the cache in bytes
+    :return: cache, or None if capacity is 0
+    """
+    if capacity <= 0:
+        return None
+    return {'tiles': OrderedDict(), 'capacity': capacity, 'size': 0, 'hits': 0, 'misses': 0,
+            'lock': threading.Lock()}
+
+
+def cachedtile(osr, cache, level, col, row, tile_size, scale_factor_width, scale_factor_height):
+    """
+    Gets a native tile of a slide level, decoding it only if it is not cached
+    :param osr: slide image
+    :param cache: tile cache, from tilecache
+    :param level: slide level
+    :param col: tile column
+    :param row: tile row
+    :param tile_size: native tile width and height of the level
+    :param scale_factor_width: width of level 0 over the width of the level
+    :param scale_factor_height: height of level 0 over the height of the level
+    :return: RGB array of the tile
+    """
+    key = (level, col, row)
+    with cache['lock']:
+        tile = cache['tiles'].get(key)
+        if tile is not None:
+            cache['tiles'].move_to_end(key)
+            cache['hits'] += 1
+            return tile
+        cache['misses'] += 1
+
+    tile_width, tile_height = tile_size
+    tile = np.asarray(osr.read_region([int(col * tile_width * scale_factor_width),
+                                       int(row * tile_height * scale_factor_height)],
+                                      level, [tile_width, tile_height]).convert('RGB'))
+
+    with cache['lock']:
+        if key not in cache['tiles']:
+            cache['tiles'][key] = tile
+            cache['size'] += tile.nbytes
+        while cache['size'] > cache['capacity']:
+            cache['size'] -= cache['tiles'].popitem(last=False)[1].nbytes
+    return tile
+
+
+def readregion(osr, read, cache=None):
+    """
+    Reads a region of the slide once, for all the chips inside it
+    :param osr: slide image
+    :param read: (level, x, y, width, height, chips) region, where chips is a
+                 list of (chip name, keys, level, col, row, scale width,
+                 scale height)
+    :param cache: tile cache, from tilecache. Tiles shared with neighbouring
+                  regions (overlapping chips) are then decoded once, at levels
+                  with an integral downsample
+    :return: RGB array of the region
+    """
+    level, x, y, width, height, chips = read
+    scale_factor_width = chips[0][5]
+    scale_factor_height = chips[0][6]
+
+    # OpenSlide resamples reads that do not start on a pixel of the level,
+    # at a phase that depends on where the read starts, so regions are only
+    # assembled from tiles where every read starts on a pixel
+    downsample = osr.level_downsamples[level]
+    aligned = downsample == int(downsample) == scale_factor_width == scale_factor_height
+
+    with timed('read', level) as timing:
+        timing['bytes'] = width * height * 3
+        if cache is None or not aligned:
+            return np.asarray(osr.read_region([int(x * scale_factor_width), int(y * scale_factor_height)],
+                                              level, [width, height]).convert('RGB'))
+
+        # assemble the region from the native tiles covering it
+        tile_width, tile_height = tilesize(osr, level)
+        region = np.empty((height, width, 3), dtype=np.uint8)
+        for row in range(y // tile_height, (y + height - 1) // tile_height + 1):
+            for col in range(x // tile_width, (x + width - 1) // tile_width + 1):
+                tile = cachedtile(osr, cache, level, col, row, (tile_width, tile_height),
+                                  scale_factor_width, scale_factor_height)
+                x0, x1 = max(x, col * tile_width), min(x + width, (col + 1) * tile_width)
+                y0, y1 = max(y, row * tile_height), min(y + height, (row + 1) * tile_height)
+                region[y0 - y:y1 - y, x0 - x:x1 - x] = tile[y0 - row * tile_height:y1 - row * tile_height,
+                                                            x0 - col * tile_width:x1 - col * tile_width]
+        return region
+
+
+def cutregion(mask, read, region, chip_size):
+    """
+    Cuts the chips and their masks out of a region read from the slide
+    :param mask: annotation mask, from makemask or loadmask
+    :param read: region read, see readregion
+    :param region: RGB array of the region
+    :param chip_size: the size of the image chips
+    :return: generator of (chip name, keys, level, col, row, chip array, mask array)
+    """
+    _, x, y, _, _, chips = read
+    for filename, keys, i, col, row, _, _ in chips:
+        # cut the chip out of the region
+        chip = region[row - y:row - y + chip_size, col - x:col - x + chip_size]
+
+        # load image mask from the level of the chip and pad it
+        with timed('mask', i) as timing:
+            img_mask = levelmask(mask, i, col, row, chip_size, chip_size)
+            img_mask = curatemask(img_mask, 1, 1, chip_size)
+            timing['bytes'] = img_mask.nbytes
+
+        yield filename, keys, i, col, row, chip, img_mask
+
+
+def cutchips(osr, mask, read, chip_size, cache=None):
+    """
+    Reads a region of the slide once and cuts the chips and masks out of it
+    :param osr: slide image
+    :param mask: annotation mask, from makemask or loadmask
+    :param read: region read, see readregion
+    :param chip_size: the size of the image chips
+    :param cache: tile cache, from tilecache
+    :return: generator of (chip name, keys, level, col, row, chip array, mask array)
+    """
+    return cutregion(mask, read, readregion(osr, read, cache), chip_size)
+
+
+# Calls, wall seconds, cpu seconds and bytes of the instrumented steps of this
+# process, by slide, step and level, and the cProfile output directory
+_timings = {'slide': None, 'steps': {}, 'lock': threading.Lock(), 'cprofile': None}
+_timingfields = ('slide', 'step', 'level', 'calls', 'wall', 'cpu', 'bytes')
+
+
+@contextmanager
+def timed(step, level=None):
+    """
+    Records the wall and cpu time of a block under the current slide. The cpu
+    time is the time of the calling thread
+    :param step: name of the step
+    :param level: slide level of the step, None for steps of the whole slide
+    :return: dictionary whose 'bytes' the block sets to the bytes it handled
+    """
+    timing = {'bytes': 0}
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield timing
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+        with _timings['lock']:
+            step = _timings['steps'].setdefault((_timings['slide'], step, level), [0, 0.0, 0.0, 0])
+            step[0] += 1
+            step[1] += wall
+            step[2] += cpu
+            step[3] += timing['bytes']
+
+
+def timings(slide=None):
+    """
+    Gets the instrumented steps of this process
+    :param slide: only gets the steps of this slide if given
+    :return: list of (slide, step, level, calls, wall seconds, cpu seconds, bytes)
+    """
+    with _timings['lock']:
+        return [key + tuple(value) for key, value in _timings['steps'].items() if slide in (None, key[0])]
+
+
+def mergetimings(rows):
+    """
+    Adds the instrumented steps of another process to those of this process
+    :param rows: rows from timings
+    :return:
+    """
+    with _timings['lock']:
+        for row in rows:
+            step = _timings['steps'].setdefault(tuple(row[:3]), [0, 0.0, 0.0, 0])
+            for index, value in enumerate(row[3:]):
+                step[index] += value
+
+
+def writetimings(path, rows):
+    """
+    Writes instrumented steps as a JSON report and a CSV table
+    :param path: path of the report without extension
+    :param rows: rows from timings
+    :return:
+    """
+    rows = sorted(rows, key=lambda row: (str(row[0]), -row[5]))
+    ensuredirectory(os.path.dirname(path) or '.')
+    with open(path + '.json', 'w') as file:
+        json.dump([dict(zip(_timingfields, row)) for row in rows], file, indent=1)
+    with open(path + '.csv', 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(_timingfields)
+        writer.writerows(rows)
+
+
+def readtimings(path):
+    """
+    Reads a JSON report of instrumented steps
+    :param path: path of the report without extension
+    :return: rows as from timings
+    """
+    with open(path + '.json') as file:
+        return [tuple(row[field] for field in _timingfields) for row in json.load(file)]
+
+
+def reporttimings(rows):
+    """
+    Prints the instrumented steps, most cpu time first
+    :param rows: rows from timings
+    :return:
+    """
+    print('step       level   calls    wall s     cpu s        MB')
+    for _, step, level, calls, wall, cpu, nbytes in sorted(rows, key=lambda row: -row[5]):
+        print('{0:<10}{1:>6}{2:>8}{3:>10.1f}{4:>10.1f}{5:>10.1f}'.format(
+            step, '' if level is None else level, calls, wall, cpu, nbytes / 2 ** 20))
+
+
+@contextmanager
+def profiled(name):
+    """
+    Runs a block under cProfile when the profile parameter is cprofile, and
+    dumps its statistics to <cprofile directory>/<name>.<pid>.<thread>.prof.
+    Threads are named after their stage, as shown by py-spy --threads
+    :param name: name of the profiled block
+    :return:
+    """
+    directory = _timings['cprofile']
+    if directory is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        ensuredirectory(directory)
+        profiler.dump_stats(os.path.join(directory, '{0}.{1}.{2}.prof'.format(
+            name, os.getpid(), threading.current_thread().name)))
+
+
+# Marks the end of the items of a stage, and an item that failed
+_finished = object()
+_failed = object()
+
+
+def runstages(source, stages, queue_size, stats):
+    """
+    Runs items through a pipeline of stages. Each stage has its own threads,
+    and stages are connected by bounded queues, so a slow stage holds back the
+    stages before it instead of letting items pile up in memory
+    :param source: iterable of items for the first stage
+    :param stages: list of (name, function, threads), where function takes an
+                   item and returns an iterable of items for the next stage
+    :param queue_size: maximum number of items waiting between two stages
+    :param stats: dictionary of stage name and [items, busy seconds], updated in place
+    :return: generator of the items out of the last stage
+    """
+    queues = [queue.Queue(queue_size) for _ in range(len(stages) + 1)]
+    lock = threading.Lock()
+    running = [threads for _, _, threads in stages]
+
+    def feed():
         try:
-            pool = ThreadPool(cpus)
-        except Exception as err:
-            print('No sub pool created')
-        start = timeit.default_timer()
-        for i in range(levels):
-            results.append(pool.apply_async(_getchips, args=(_save_count_blank,_save_count_annotated, i,)))
-        pool.close()
-        pool.join()
-        print('get chips takes:',timeit.default_timer() - start)
-        image_dict = defaultdict(list)
-        chip_dict = defaultdict(list)
-        for result in results:
-            image_dict.update(result.get()[0])
-            chip_dict.update(result.get()[1])
-    else:
-        print('processing level {0}'.format(level + 1))
-        image_dict, chip_dict = _getchips(_save_count_blank,_save_count_annotated, level)
+            for item in source:
+                queues[0].put(item)
+        except BaseException as error:
+            queues[-1].put((_failed, error))
+        for _ in range(stages[0][2]):
+            queues[0].put(_finished)
+
+    def work(index, name, function):
+        items, busy = 0, 0.0
+        inbox, outbox = queues[index], queues[index + 1]
+        try:
+            with profiled(name):
+                for item in iter(inbox.get, _finished):
+                    items += 1
+                    start = time.perf_counter()
+                    for result in function(item):
+                        # time spent waiting on the next stage is not counted
+                        busy += time.perf_counter() - start
+                        outbox.put(result)
+                        start = time.perf_counter()
+                    busy += time.perf_counter() - start
+        except BaseException as error:
+            queues[-1].put((_failed, error))
+            return
+        with lock:
+            stats.setdefault(name, [0, 0.0])
+            stats[name][0] += items
+            stats[name][1] += busy
+            running[index] -= 1
+            last = running[index] == 0
+        if last:
+            for _ in range(stages[index + 1][2] if index + 1 < len(stages) else 1):
+                outbox.put(_finished)
+
+    threads = [threading.Thread(target=feed, name='feed', daemon=True)]
+    for index, (name, function, count) in enumerate(stages):
+        threads += [threading.Thread(target=work, args=(index, name, function), daemon=True,
+                                     name='{0}-{1}'.format(name, thread)) for thread in range(count)]
+    for thread in threads:
+        thread.start()
+
+    for item in iter(queues[-1].get, _finished):
+        if type(item) is tuple and len(item) == 2 and item[0] is _failed:
+            raise item[1]
+        yield item
+
+
+def reportstages(stats, elapsed):
+    """
+    Prints the throughput of each pipeline stage
+    :param stats: dictionary of stage name and [items, busy seconds], from runstages
+    :param elapsed: wall clock seconds of the pipeline
+    :return:
+    """
+    print('stage      items    busy s   items/s busy   items/s wall')
+    for name, (items, busy) in stats.items():
+        if name == 'tiles':
+            continue
+        print('{0:<8}{1:>8}{2:>10.1f}{3:>15.1f}{4:>15.1f}'.format(
+            name, items, busy, items / busy if busy else 0, items / elapsed if elapsed else 0))
+    if 'tiles' in stats:
+        hits, misses = stats['tiles']
+        print('tile cache: {0} hits, {1} misses ({2:.0%} hit rate)'.format(
+            int(hits), int(misses), hits / (hits + misses) if hits + misses else 0))
 
 
-    return chip_dict, image_dict
+# State of a chip saving worker, set by initworker
+_worker = {}
 
-def run(parameters, filename, convert=False):
+
+def initworker(slide_path, shared, plan, chip_size, quality, output_dir, output_type='files', write_policy='none',
+               tile_cache=0, cprofile=None):
     """
-    Runs SlideSeg: Generates image chips from a whole slide image.
+    Initializes a chip saving worker process with its own slide handles, and
+    the memory mapped annotation mask and chip plan
+    :param slide_path: path to the whole slide image
+    :param shared: dictionary describing the shared mask, from sharemask
+    :param plan: dictionary describing the shared chip plan, from shareplan
+    :param chip_size: the size of the image chips
+    :param quality: the output quality
+    :param output_dir: output directory of the slide
+    :param output_type: 'files' saves every chip and mask as its own file,
+                        'tar' returns them encoded for writeshards
+    :param write_policy: page cache policy of the written files, see writefile
+    :param tile_cache: size in bytes of the decoded tile cache shared by the read threads (0 = no cache)
+    :param cprofile: directory of the cProfile statistics of the stage threads, None to not profile
+    :return:
+    """
+    _timings['slide'] = os.path.basename(slide_path)
+    _timings['cprofile'] = cprofile
+
+    # read threads each take a slide handle from the pool, as one handle
+    # serializes its reads
+    _worker['slide_path'] = slide_path
+    _worker['slides'] = queue.Queue()
+    _worker['slides'].put(OpenSlide(slide_path))
+    _worker['tiles'] = tilecache(tile_cache)
+    _worker['mask'] = loadmask(shared)
+    _worker['chips'] = loadplan(plan)
+    _worker['chip_size'] = chip_size
+    _worker['quality'] = quality
+    _worker['output_dir'] = output_dir
+    _worker['output_type'] = output_type
+    _worker['write_policy'] = write_policy
+
+
+def readstage(read):
+    """
+    Pipeline stage reading the region of a read of chip indices
+    """
+    read = readchips(_worker['chips'], read)
+    try:
+        osr = _worker['slides'].get_nowait()
+    except queue.Empty:
+        osr = OpenSlide(_worker['slide_path'])
+    try:
+        region = readregion(osr, read, _worker['tiles'])
+    finally:
+        _worker['slides'].put(osr)
+    yield read, region
+
+
+def tilestats(stats):
+    """
+    Adds the hits and misses of the tile cache of a worker to its stage statistics
+    :param stats: dictionary of stage name and [items, busy seconds], from runstages
+    :return:
+    """
+    if _worker['tiles'] is not None:
+        stats['tiles'] = [_worker['tiles']['hits'], _worker['tiles']['misses']]
+
+
+def maskstage(item):
+    """
+    Pipeline stage cutting the chips and masks out of a region
+    """
+    read, region = item
+    return cutregion(_worker['mask'], read, region, _worker['chip_size'])
+
+
+def encodestage(item):
+    """
+    Pipeline stage encoding a chip and its mask with their tags
+    """
+    filename, keys, i, col, row, chip, img_mask = item
+    suffix = os.path.splitext(filename)[1].strip('.')
+    chip_bytes = io.BytesIO()
+    mask_bytes = io.BytesIO()
+    with timed('encode', i) as timing:
+        writechip(Image.fromarray(chip), chip_bytes, suffix, _worker['quality'], keys)
+        writemask(img_mask, mask_bytes, suffix, keys)
+        timing['bytes'] = chip_bytes.tell() + mask_bytes.tell()
+    yield filename, keys, i, col, row, chip_bytes.getvalue(), mask_bytes.getvalue()
+
+
+def writestage(sample):
+    """
+    Pipeline stage saving an encoded chip and mask in the tag based subfolders,
+    which keydirectories created beforehand. Samples for tar shards are passed
+    on to the shard writer
+    """
+    if _worker['output_type'] == 'tar':
+        yield sample
+        return
+
+    filename, keys, i, _, _, chip_bytes, mask_bytes = sample
+    keysDir = ' '.join(keys)
+    with timed('write', i) as timing:
+        for directory, data in (('image_chips', chip_bytes), ('image_mask', mask_bytes)):
+            path = '{0}{1}/{2}/{3}'.format(_worker['output_dir'], keysDir, directory, filename)
+            writefile(path, data, _worker['write_policy'])
+        timing['bytes'] = len(chip_bytes) + len(mask_bytes)
+    yield filename
+
+
+def workerstages(threads):
+    """
+    Stages of the chip saving pipeline of a worker
+    :param threads: threads of the read, mask, encode and write stages
+    :return: list of (name, function, threads)
+    """
+    return list(zip(('read', 'mask', 'encode', 'write'), (readstage, maskstage, encodestage, writestage), threads))
+
+
+def pipelineworker(initargs, tasks, results, threads, queue_size):
+    """
+    Worker process running the chip saving pipeline on the reads of a shared queue
+    :param initargs: arguments of initworker
+    :param tasks: queue of reads, ended by None
+    :param results: queue of saved chip names (or tar samples), ended by the stage statistics
+                    and instrumented steps
+    :param threads: threads of the read, mask, encode and write stages
+    :param queue_size: maximum number of items waiting between two stages
+    :return:
+    """
+    # steps recorded by the slide process before the fork are reported by it
+    _timings['steps'] = {}
+    initworker(*initargs)
+    stats = {}
+    for result in runstages(iter(tasks.get, None), workerstages(threads), queue_size, stats):
+        results.put(result)
+    tilestats(stats)
+    results.put(('stats', stats, timings()))
+
+
+def collectresults(results, processes, stats):
+    """
+    Collects the saved chips of the pipeline worker processes
+    :param results: queue of saved chip names (or tar samples), stage statistics and instrumented steps
+    :param processes: pipeline worker processes
+    :param stats: dictionary of stage name and [items, busy seconds], summed over the workers.
+                  The instrumented steps of the workers are merged into those of this process
+    :return: generator of saved chip names (or tar samples)
+    """
+    finished = 0
+    while finished < len(processes):
+        try:
+            result = results.get(timeout=5)
+        except queue.Empty:
+            if any(process.exitcode not in (None, 0) for process in processes):
+                raise RuntimeError('a chip saving worker process failed')
+            continue
+
+        if type(result) is tuple and result[0] == 'stats':
+            for name, (items, busy) in result[1].items():
+                stats.setdefault(name, [0, 0.0])
+                stats[name][0] += items
+                stats[name][1] += busy
+            mergetimings(result[2])
+            finished += 1
+        else:
+            yield result
+
+
+def savereads(read):
+    """
+    Reads a region of the slide and saves the chips and masks inside it
+    :param read: region read of chip indices, see planreads
+    :return: names of the chips saved, or the encoded chips and masks if the
+             output type is 'tar'
+    """
+    items = [read]
+    for _, function, _ in workerstages((1, 1, 1, 1)):
+        items = [result for item in items for result in function(item)]
+    return items
+
+
+def planslide(parameters, filename, convert=False):
+    """
+    Plans the chips of a whole slide image: loads the annotation mask, finds
+    the chips to save, groups them into region reads and leaves out the chips
+    kept from an earlier run
     :param parameters: specified in Parameters.txt file
     :param filename: filename of whole slide image
-    :return: image chips and masks.
+    :param convert: only converts the annotation mask to tiff if true
+    :return: dictionary describing the slide plan, or None if there is nothing
+             to save (slide finished, mask converted or invalid parameters)
     """
 
     # Define variables
@@ -571,14 +2383,36 @@ def run(parameters, filename, convert=False):
     _key = parameters["key"]
     _save_all = parameters["save_all"]
     _save_ratio = float(parameters["save_ratio"])
+    _sample_seed = int(parameters.get("sample_seed", 0))
+    _sample_by_level = parameters.get("sample_by_level", False) is True
     _process_level = parameters["level"]
     _cpus = int(parameters["cpus"])
+    _read_size = int(parameters.get("read_size", 4096))
+    _min_tissue = float(parameters.get("min_tissue", 0))
+    _output_type = parameters.get("output_type", "files")
+    _resume = parameters.get("resume", True) is True
+
+    if _output_type not in ('files', 'tar'):
+        print('Please select from files or tar for output_type')
+        return None
+
+    xml_file = filename.rstrip(".svs")
+    xml_file = xml_file + ".xml"
+
+    # Skip slides finished by an earlier run with the same parameters and annotations
+    _journal_path = '{0}{1}/journal.txt'.format(_output_dir, filename)
+    _inputs = ('{0}{1}'.format(_slide_path, filename), '{0}{1}'.format(_xml_path, xml_file), _key)
+    journaled, complete = loadjournal(_journal_path)
+    if not convert and _resume and complete == inputsdigest(parameters, _inputs):
+        print('{0} already finished, skipping'.format(filename))
+        return None
 
     if _process_level not in ('lowest','highest','all','40.0','20.0','10.0','5.0','2.5'):
         print('Please select from lowest, highest, all or [40.0, 20.0, 10.0, 5.0, 2.5] for level')
-        return
+        return None
 
     # Open slide
+    _timings['slide'] = filename
     _osr, _levels, _dims, availableMag = openwholeslide('{0}{1}'.format(_slide_path, filename))
 
     _size = (int(_dims[0][0]), int(_dims[0][1]))
@@ -587,91 +2421,276 @@ def run(parameters, filename, convert=False):
     level = getDesireLevel(_process_level, _levels, availableMag)
 
     # Annotation Mask
-    xml_file = filename.rstrip(".svs")
-    xml_file = xml_file + ".xml"
-
     print(('loading annotation data from {0}/{1}'.format(_xml_path, xml_file)))
-    _mask, _annotations = makemask(_key, _size, '{0}{1}'.format(_xml_path, xml_file))
+    # the mask tiff is sampled from the polygons tile by tile, without a mask pyramid
+    _mask, _annotations = makemask(_key, _size, '{0}{1}'.format(_xml_path, xml_file), _dims,
+                                   0 if convert else 2 ** 28)
 
     if convert:
         maskDest = 'mask'
         if not os.path.exists(maskDest):
             os.makedirs(maskDest)
-        print(_mask.shape)
+        print(_size)
         _path_mask = maskDest +'/' + filename.rstrip(".svs") + '.tiff'
-        cv2.imwrite(_path_mask, _mask[:,:])
-    else:
-        # try:
-        # xml_entire_path = parameters["xml_entire_path"]
-        # saveEntiremask(_mask, '{0}{1}'.format(xml_entire_path, filename + ".tiff"))
-        # print(('Saving entire xml to tif... {0}'.format(filename + ".tiff")))
-        # except:
-
-        _output_dir = _output_dir + filename + '/'
-        # Define output directory
-        output_directory_chip = '{0}image_chips/'.format(_output_dir)
-        output_directory_mask = '{0}image_mask/'.format(_output_dir)
-
-        # Output formatting check
-        _format, _suffix = formatcheck(_format)
-
-        # Find chip data/locations to be saved
-        chip_dictionary, image_dict = getchips(_levels, _dims, _chip_size, _overlap,
-                                           _mask, _annotations, filename, _suffix, _save_all, _save_ratio, _cpus, level=level)
-
-        # Save chips and masks
-        print(('pid:{0} is Saving chips... {1} total chips'.format(os.getpid(), len(chip_dictionary))))
-
-        def _saveChipsAndMask(filename, value):
-            keys = value[0]
-            i = value[1]
-
-            col = value[2]
-            row = value[3]
-            scale_factor_width = value[4]
-            scale_factor_height = value[5]
-    
-            # load chip region from slide image
-            img = _osr.read_region([int(col * scale_factor_width), int(row * scale_factor_height)], i,
-                                  [_chip_size, _chip_size]).convert('RGB')
-    
-            # load image mask and curate
-            img_mask = _mask[int(row * scale_factor_height):int((row + _chip_size) * scale_factor_height),
-                             int(col * scale_factor_width):int((col + _chip_size) * scale_factor_width)]
-    
-            img_mask = curatemask(img_mask, scale_factor_width, scale_factor_height, _chip_size)
-
-            # Tag based subfolder
-            keysDir  = ''
-            for key in keys:
-                if keysDir != '':
-                    keysDir = keysDir + ' ' + key
-                else:
-                    keysDir = keysDir + key
-            output_directory_chip = '{0}{1}/image_chips/'.format(_output_dir, keysDir)
-            output_directory_mask = '{0}{1}/image_mask/'.format(_output_dir, keysDir)
-
-            # save the image chip and image mask
-            _path_chip = output_directory_chip + filename
-            _path_mask = output_directory_mask + filename
-
-
-            savechip(img, _path_chip, _quality, keys)
-            savemask(img_mask, _path_mask, keys)
-
-
-        pool = ThreadPool(_cpus)
-        for filename, value in tqdm.tqdm(iter(chip_dictionary.items())):
-            pool.apply_async(_saveChipsAndMask, args=(filename,value,))
-            # _saveChipsAndMask(filename, value)
-        pool.close()
-        pool.join()
+        writemasktiff(_mask, _path_mask, _cpus, _osr.properties.get('openslide.mpp-x'))
+        return None
+
+    # try:
+    # xml_entire_path = parameters["xml_entire_path"]
+    # saveEntiremask(_mask, '{0}{1}'.format(xml_entire_path, filename + ".tiff"))
+    # print(('Saving entire xml to tif... {0}'.format(filename + ".tiff")))
+    # except:
+
+    _output_dir = _output_dir + filename + '/'
+
+    # Output formatting check
+    _format, _suffix = formatcheck(_format)
+
+    # Detect tissue to skip background glass
+    _tissue = None
+    if _min_tissue > 0:
+        with timed('tissue'):
+            _tissue = tissuemask(_osr, _levels, _dims)
+
+    # Find chip data/locations to be saved
+    with timed('plan'):
+        chips = getchips(_levels, _dims, _chip_size, _overlap, _mask, _annotations, filename, _suffix, _save_all,
+                         _save_ratio, _cpus, level=level, tissue=_tissue, min_tissue=_min_tissue, seed=_sample_seed,
+                         stratify=_sample_by_level)
+
+        reads = planreads(chips, _chip_size, _read_size, [tilesize(_osr, i) for i in range(_levels)])
+    print('{0} chips in {1} region reads'.format(len(chips['table']), len(reads)))
+
+    # Chips written by an earlier run with the same content are kept, tar
+    # shards are always rewritten as a whole
+    with timed('digest'):
+        digests = chipdigests(_mask, chips, _chip_size, '{0} {1} {2} {3}'.format(
+            _inputs[0], os.stat(_inputs[0]).st_mtime_ns, _chip_size, _quality))
+    written = {}
+    kept = np.zeros(len(chips['table']), dtype=bool)
+    if _resume and _output_type == 'files' and journaled:
+        keysets, keyset = chipkeys(chips)
+        for name, index in zip(journaled, chipindex(chips, list(journaled)).tolist()):
+            digest, keysDir = journaled[name]
+            if index >= 0 and digests[index] == digest.encode() and ' '.join(keysets[keyset[index]]) == keysDir:
+                written[name] = journaled[name]
+                kept[index] = True
+        if written:
+            print('{0}: {1} of {2} chips unchanged'.format(filename, len(written), len(chips['table'])))
+
+    # Remove chips of the last run that are not kept
+    for name, (digest, keysDir) in journaled.items():
+        if name not in written:
+            for directory in ('image_chips', 'image_mask'):
+                path = '{0}{1}/{2}/{3}'.format(_output_dir, keysDir, directory, name)
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    tasks = []
+    for i, x, y, width, height, indices in reads:
+        indices = indices[~kept[indices]]
+        if len(indices):
+            tasks.append((i, x, y, width, height, indices))
+
+    return {'filename': filename,
+            'slide_path': _inputs[0],
+            'inputs': _inputs,
+            'xml_file': xml_file,
+            'journal_path': _journal_path,
+            'output_dir': _output_dir,
+            'chip_size': _chip_size,
+            'quality': _quality,
+            'output_type': _output_type,
+            'mask': _mask,
+            'annotations': _annotations,
+            'chips': chips,
+            'digests': digests,
+            'written': written,
+            'tasks': tasks}
+
+
+def journalchips(journal, plan, names):
+    """
+    Records chips whose chip and mask were written in the journal of their slide
+    :param journal: journal file, from startjournal
+    :param plan: slide plan, from planslide
+    :param names: names of the written chips
+    :return:
+    """
+    keysets, keyset = chipkeys(plan['chips'])
+    journal.write(''.join('{0}\t{1}\t{2}\n'.format(plan['digests'][index].decode(), name,
+                                                   ' '.join(keysets[keyset[index]]))
+                          for name, index in zip(names, chipindex(plan['chips'], names).tolist())))
+    journal.flush()
+
+
+def finishslide(parameters, plan, journal):
+    """
+    Writes the text output of a slide once all of its chips are saved, and
+    marks the slide as finished in its journal
+    :param parameters: specified in Parameters.txt file
+    :param plan: slide plan, from planslide
+    :param journal: journal file, from startjournal
+    :return:
+    """
+
+    # Make text output of Annotation Data
+    print('Updating txt file details...')
 
-        # Make text output of Annotation Data
-        print('Updating txt file details...')
+    writekeys(plan['xml_file'], plan['annotations'])
+    writeimagelist(plan['xml_file'], plan['chips'])
 
-        writekeys(xml_file, _annotations)
-        writeimagelist(xml_file, image_dict)
+    print('txt file details updated')
 
-        print('txt file details updated')
+    # the annotation key may have been extended while loading the mask
+    journal.write('complete {0}\n'.format(inputsdigest(parameters, plan['inputs'])))
+    journal.flush()
 
+
+def run(parameters, filename, convert=False):
+    """
+    Runs SlideSeg: Generates image chips from a whole slide image.
+    :param parameters: specified in Parameters.txt file
+    :param filename: filename of whole slide image
+    :return: image chips and masks.
+    """
+    _cpus = int(parameters["cpus"])
+    _shard_size = int(parameters.get("shard_size", 1000))
+    _threads = [int(parameters.get(name, 1)) for name in ("read_threads", "mask_threads", "encode_threads",
+                                                           "write_threads")]
+    _queue_size = int(parameters.get("queue_size", 4))
+    _write_policy = parameters.get("write_policy", "none")
+    _tile_cache = int(float(parameters.get("tile_cache", 0)) * 2 ** 20)
+    _profile = parameters.get("profile", "none")
+
+    # cProfile statistics of planning and of every stage thread
+    _cprofile = None
+    if _profile == 'cprofile':
+        _cprofile = '{0}{1}/profile/'.format(parameters["output_dir"], filename)
+    _timings['cprofile'] = _cprofile
+
+    with profiled('plan'):
+        plan = planslide(parameters, filename, convert)
+    if plan is None:
+        return
+
+    # Save chips and masks
+    tasks = plan['tasks']
+    print(('pid:{0} is Saving chips... {1} total chips'.format(os.getpid(), len(plan['digests']))))
+
+    # Worker processes open their own slide handle and memory map the mask and chip plan
+    shared_dir = tempfile.mkdtemp(prefix='slideseg3_')
+    journal = startjournal(plan['journal_path'], plan['written'])
+    processes = []
+    try:
+        initargs = (plan['slide_path'], sharemask(plan['mask'], shared_dir), shareplan(plan['chips'], shared_dir),
+                    plan['chip_size'], plan['quality'], plan['output_dir'], plan['output_type'], _write_policy,
+                    _tile_cache, _cprofile)
+        if plan['output_type'] == 'files':
+            keydirectories(plan['output_dir'], [' '.join(keys) for keys in chipkeys(plan['chips'])[0]])
+        stats = {}
+        start = time.perf_counter()
+        if _cpus > 1:
+            # reads are handed out through a bounded queue, each worker process
+            # runs its own pipeline of read, mask, encode and write threads
+            task_queue = Queue(_queue_size)
+            result_queue = Queue(_queue_size * _cpus)
+            processes = [Process(target=pipelineworker, args=(initargs, task_queue, result_queue, _threads,
+                                                              _queue_size), daemon=True)
+                         for _ in range(_cpus)]
+            for process in processes:
+                process.start()
+            threading.Thread(target=lambda: [task_queue.put(task) for task in tasks + [None] * _cpus],
+                             daemon=True).start()
+            results = collectresults(result_queue, processes, stats)
+        else:
+            initworker(*initargs)
+            results = runstages(tasks, workerstages(_threads), _queue_size, stats)
+        results = tqdm.tqdm(results, total=sum(len(task[5]) for task in tasks))
+
+        if plan['output_type'] == 'tar':
+            # Encoded chips of every worker are streamed into the shards of the slide
+            writeshards(results, '{0}shards/'.format(plan['output_dir']), os.path.splitext(filename)[0],
+                        _shard_size)
+        else:
+            # Record every saved chip, so a restart only redoes unsaved chips
+            for name in results:
+                journalchips(journal, plan, [name])
+
+        for process in processes:
+            process.join()
+        if not processes:
+            tilestats(stats)
+        reportstages(stats, time.perf_counter() - start)
+        reporttimings(timings(filename))
+        if _profile in ('report', 'cprofile'):
+            writetimings('{0}profile'.format(plan['output_dir']), timings(filename))
+
+        finishslide(parameters, plan, journal)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        journal.close()
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+def iter_chips(parameters, filename):
+    """
+    Generates image chips from a whole slide image without writing them to disk.
+    Slide regions are read one at a time as the chips are consumed
+    :param parameters: specified in Parameters.txt file
+    :param filename: filename of whole slide image
+    :return: generator of (chip array, mask array, keys, level, row, col)
+    """
+
+    # Define variables
+    _slide_path = parameters["slide_path"]
+    _xml_path = parameters["xml_path"]
+    _chip_size = int(parameters["size"])
+    _overlap = int(parameters["overlap"])
+    _key = parameters["key"]
+    _save_all = parameters["save_all"]
+    _save_ratio = float(parameters["save_ratio"])
+    _sample_seed = int(parameters.get("sample_seed", 0))
+    _sample_by_level = parameters.get("sample_by_level", False) is True
+    _process_level = parameters["level"]
+    _cpus = int(parameters["cpus"])
+    _read_size = int(parameters.get("read_size", 4096))
+    _min_tissue = float(parameters.get("min_tissue", 0))
+    _tiles = tilecache(int(float(parameters.get("tile_cache", 0)) * 2 ** 20))
+
+    if _process_level not in ('lowest','highest','all','40.0','20.0','10.0','5.0','2.5'):
+        raise ValueError('Please select from lowest, highest, all or [40.0, 20.0, 10.0, 5.0, 2.5] for level')
+
+    # Open slide
+    _timings['slide'] = filename
+    _osr, _levels, _dims, availableMag = openwholeslide('{0}{1}'.format(_slide_path, filename))
+    # the slide is closed when the chips run out, or the generator is closed early
+    try:
+        _size = (int(_dims[0][0]), int(_dims[0][1]))
+        level = getDesireLevel(_process_level, _levels, availableMag)
+
+        # Annotation Mask
+        xml_file = filename.rstrip(".svs") + ".xml"
+        _mask, _annotations = makemask(_key, _size, '{0}{1}'.format(_xml_path, xml_file), _dims)
+
+        _format, _suffix = formatcheck(parameters["format"])
+
+        _tissue = None
+        if _min_tissue > 0:
+            _tissue = tissuemask(_osr, _levels, _dims)
+
+        chips = getchips(_levels, _dims, _chip_size, _overlap, _mask, _annotations, filename, _suffix,
+                                      _save_all, _save_ratio, _cpus, level=level, tissue=_tissue, min_tissue=_min_tissue,
+                                      seed=_sample_seed, stratify=_sample_by_level)
+
+        reads = planreads(chips, _chip_size, _read_size, [tilesize(_osr, i) for i in range(_levels)])
+        for read in reads:
+            read = readchips(chips, read)
+            for _, keys, i, col, row, chip, img_mask in cutchips(_osr, _mask, read, _chip_size, _tiles):
+                # copy the chip so the region can be released once its chips are consumed, and
+                # the mask, which may be a view of the mask pyramid shared by every chip
+                yield chip.copy(), img_mask.copy(), keys, i, row, col
+    finally:
+        _osr.close()